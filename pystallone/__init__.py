@@ -43,11 +43,18 @@ from jpype import \
  getDefaultJVMPath, \
  JavaException, \
  JArray, JInt, JDouble, JString, JObject, JPackage, \
- java, javax, nio as _nio
+ java, javax, nio as _nio, \
+ attachThreadToJVM as _attachThreadToJVM, \
+ isThreadAttachedToJVM as _isThreadAttachedToJVM
 
 import numpy as _np
 import sys as _sys
 import warnings as _warnings
+import logging as _logging
+import threading as _threading
+import traceback as _traceback
+from contextlib import contextmanager as _contextmanager
+from multiprocessing.pool import ThreadPool as _ThreadPool
 from ._version import get_versions
 
 __version__ = get_versions()['version']
@@ -59,13 +66,37 @@ del _sys
 """
 types wrapped in stallone java library
 """
-_supported_types = [_np.int32, _np.int64, _np.float32, _np.float64]
+_supported_types = [_np.int32, _np.int64, _np.float32, _np.float64,
+                    _np.complex128]
+
+"""
+maximum length of java arrays and capacity (in bytes) of ByteBuffers.
+Larger data has to be split, see pystallone.arrays.SegmentedArray
+"""
+_max_java_length = 2**31 - 1
+
+"""
+take copies rows separated by fewer than this number of elements as one block
+"""
+_take_gap = 1024
 
 """ stallone java package. Should be used to access all classes in the stallone library."""
 stallone = None
 """ main stallone API entry point """
 API = None
 
+""" jvm path and arguments given to startJVM, used to start worker JVMs """
+_jvm_path = None
+_jvm_args = None
+
+""" copy audit settings, see set_strict_copies """
+_strict_action = None
+_strict_threshold = 0
+""" per thread copy audit settings of strict_copies blocks """
+_strict_local = _threading.local()
+
+_log = _logging.getLogger(__name__)
+
 # get stallone jar filename generated by setup.py
 from _file import stallone_jar
 
@@ -87,7 +118,7 @@ def startJVM(jvm=None, args=None):
     import os
     import pkg_resources
     
-    global stallone, API
+    global stallone, API, _jvm_path, _jvm_args
     
     if not jvm:
         jvm = getDefaultJVMPath()
@@ -97,6 +128,10 @@ def startJVM(jvm=None, args=None):
         
     if not args:
         args = []
+
+    # remember the arguments, so worker processes can start an equal jvm
+    _jvm_path = jvm
+    _jvm_args = list(args)
     
     def append_to_classpath(args):
         """
@@ -148,10 +183,120 @@ def startJVM(jvm=None, args=None):
         raise RuntimeError('Stallone package initialization borked.'
                            'Check your JAR/classpath!') 
 
+def _attach_thread():
+    """
+    attaches the calling python thread to the JVM. Has to be called by every
+    thread (other than the main thread) before it invokes Stallone.
+    """
+    if not _isThreadAttachedToJVM():
+        _attachThreadToJVM()
+
+def _jvm_map(func, iterable, n_jobs=None):
+    """
+    parallel map over JVM attached threads. JPype releases the GIL while
+    java code runs, so this scales for work done on the java side.
+    
+    Parameters
+    ----------
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus. 1 evaluates in the
+      calling thread.
+    """
+    if n_jobs == 1:
+        return [func(x) for x in iterable]
+    pool = _ThreadPool(n_jobs, initializer=_attach_thread)
+    try:
+        return pool.map(func, iterable)
+    finally:
+        pool.terminate()
+
+class ImplicitCopyError(RuntimeError):
+    """ raised in strict copy mode, when a conversion would copy data """
+    pass
+
+def _check_strict_action(action):
+    if action not in (None, 'raise', 'log'):
+        raise ValueError('unknown action "%s"' % action)
+
+def set_strict_copies(action='raise', threshold=0):
+    """
+    Enables the copy audit for all conversion helpers of this module. Whenever
+    a helper would copy data or change its dtype (e.g. upcasting float32 to
+    float64 or passing copy=True) for an array with more than threshold
+    elements, the given action is performed.
+    
+    This setting applies to all threads, which are not inside a strict_copies
+    block.
+    
+    Parameters
+    ----------
+    action : string or None
+      'raise' raises an ImplicitCopyError, 'log' logs a warning including the
+      stack trace to the 'pystallone' logger. None disables the audit.
+    
+    threshold : int
+      arrays with at most this number of elements are ignored.
+    """
+    global _strict_action, _strict_threshold
+    _check_strict_action(action)
+    _strict_action = action
+    _strict_threshold = threshold
+
+@_contextmanager
+def strict_copies(action='raise', threshold=0):
+    """
+    Context manager enabling the copy audit (see set_strict_copies) inside a
+    with block. The setting only applies to the calling thread and overrides
+    the one of set_strict_copies; the previous setting is restored afterwards.
+    
+    Example
+    -------
+    >>> with strict_copies('raise', threshold=10**6):
+    ...     x = ndarray_to_stallone_array(traj, copy=False) # doctest: +SKIP
+    """
+    _check_strict_action(action)
+    previous = getattr(_strict_local, 'setting', None)
+    _strict_local.setting = (action, threshold)
+    try:
+        yield
+    finally:
+        _strict_local.setting = previous
+
+def _audit_copy(size, reason):
+    """ reports a copy of size elements, if the copy audit is enabled """
+    setting = getattr(_strict_local, 'setting', None)
+    action, threshold = setting if setting is not None \
+        else (_strict_action, _strict_threshold)
+    if action is None or size <= threshold:
+        return
+    msg = 'implicit copy of %i elements: %s' % (size, reason)
+    if action == 'raise':
+        raise ImplicitCopyError(msg)
+    _log.warning('%s\n%s', msg, ''.join(_traceback.format_stack()[:-2]))
+
+def _cast_to_stallone_dtype(pyarray):
+    """
+    returns pyarray cast to the nearest type Stallone can wrap.
+
+    Stallone does currently support only wrappers for int32 and float64, so
+    float32 is upcasted and int64 is downcasted (with a warning). Arrays of
+    any other type are returned unchanged.
+    """
+    if pyarray.dtype == _np.float32:
+        _audit_copy(pyarray.size, 'upcasting float32 to float64')
+        _warnings.warn("Upcasting floats to doubles!")
+        return pyarray.astype(_np.float64)
+    if pyarray.dtype == _np.int64:
+        _audit_copy(pyarray.size, 'downcasting int64 to int32')
+        _warnings.warn("Downcasting long to 32 bit integer."
+                       " You will loose precision by doing so!")
+        return pyarray.astype(_np.int32)
+    return pyarray
+
 def ndarray_to_stallone_array(pyarray, copy=True):
     """
     Convert numpy ndarrays to the corresponding wrapped type in Stallone. 
-    Currently only int32 and double are supported in stallone.
+    Currently only int32, double and complex128 are supported in stallone.
     
     Parameters
     ----------
@@ -163,7 +308,8 @@ def ndarray_to_stallone_array(pyarray, copy=True):
     
     Returns
     -------
-    IDoubleArray or IIntArray depending on input type
+    IDoubleArray, IIntArray or IComplexArray depending on input type. Complex
+    arrays are always copied.
     
     Note:
     -----
@@ -190,15 +336,11 @@ def ndarray_to_stallone_array(pyarray, copy=True):
     factory = None
     cast_func = None
     
-    # stallone does currently support only wrappers for int32 and float64
-    if dtype == _np.float32:
-        _warnings.warn("Upcasting floats to doubles!")
-        pyarray = pyarray.astype(_np.float64)
-    if dtype == _np.int64:
-        _warnings.warn("Downcasting long to 32 bit integer."
-                       " You will loose precision by doing so!")
-        pyarray = pyarray.astype(_np.int32)
-        
+    if dtype == _np.complex128:
+        return _complex_ndarray_to_stallone_array(pyarray)
+    
+    pyarray = _cast_to_stallone_dtype(pyarray)
+
     # Pass memory to jpype and create a java array.
     # Also set corresponding factory method in stallone to wrap the array.
     if dtype == _np.float32 or dtype == _np.float64:
@@ -212,12 +354,23 @@ def ndarray_to_stallone_array(pyarray, copy=True):
     if not copy:
         if not pyarray.flags.c_contiguous:
             raise RuntimeError('Can only pass contiguous memory to Java!')
+        if pyarray.nbytes > _max_java_length:
+            raise ValueError('array of %i bytes exceeds the capacity of a java'
+                             ' ByteBuffer. Use pystallone.arrays.SegmentedArray'
+                             % pyarray.nbytes)
         jbuff = _nio.convertToDirectBuffer(pyarray)
         rows = shape[0]
         cols = 1 if len(shape) == 1 else shape[1]
         return factory.arrayFrom(jbuff, rows, cols)
 
+    _audit_copy(pyarray.size, 'copy into java array, pass copy=False to '
+                'use a direct buffer')
+
     if len(shape) == 1:
+        if shape[0] > _max_java_length:
+            raise ValueError('array of %i elements exceeds the maximum length'
+                             ' of java arrays. Use '
+                             'pystallone.arrays.SegmentedArray' % shape[0])
         # create a JArray wrapper
         jarr = JArray(cast_func)(pyarray)
         if cast_func is JDouble:
@@ -243,11 +396,22 @@ def ndarray_to_stallone_array(pyarray, copy=True):
 
 
 
-def stallone_array_to_ndarray(stArray):
+def stallone_array_to_ndarray(stArray, out=None):
     """
+    Parameters
+    ----------
+    stArray : IDoubleArray, IIntArray, IComplexArray or
+      pystallone.arrays.SegmentedArray
+    
+    out : (optional) ndarray
+      c-contiguous array of the shape and dtype (float64, int32 or
+      complex128) of the result, which will be filled with a bulk copy on the
+      java side instead of allocating a new array. Useful to keep memory flat
+      in loops.
+    
     Returns
     -------
-    ndarray : 
+    ndarray : out, if given.
     
     
     This subclass of numpy multidimensional array class aims to wrap array types
@@ -257,6 +421,12 @@ def stallone_array_to_ndarray(stArray):
     JArray<T> does not suggerate continuous memory layout, which is needed for
     direct wrapping.
     """
+    from pystallone.arrays import SegmentedArray
+    if isinstance(stArray, SegmentedArray):
+        return stArray.to_ndarray(out)
+    if isinstance(stArray, stallone.api.complex.IComplexArray):
+        return _complex_stallone_array_to_ndarray(stArray, out)
+
     # TODO: not yet released jpype returns numpy arrays, check for availability.
     # if first argument is of type IIntArray or IDoubleArray
     if not isinstance(stArray, (stallone.api.ints.IIntArray,
@@ -266,6 +436,10 @@ def stallone_array_to_ndarray(stArray):
     # TODO: support sparse
     # isSparse = d_arr.isSparse()
     
+    if out is not None:
+        _check_out(out, stArray, _stallone_dtype(stArray))
+        return _copy_into(stArray, out)
+    
     # if jpype was built against numpy, we directly obtain a numpy array with correct shape here.
     sequence = stArray.getArray()[:]
     
@@ -289,6 +463,9 @@ def stallone_array_to_ndarray(stArray):
     else:
         shape = (rows,)
     
+    _audit_copy(rows * cols, 'copy from java array, pass out= to copy into '
+                'a preallocated array')
+    
     if order < 2:
         np_array = _np.array(sequence, dtype=dtype)
     elif order == 2:
@@ -298,6 +475,241 @@ def stallone_array_to_ndarray(stArray):
     
     return np_array.reshape(shape)
 
+def _check_out(out, stArray, dtype, contiguous=True):
+    """ validates a given out array for the conversion of stArray """
+    rows = stArray.rows()
+    cols = stArray.columns()
+    shape = (rows, cols) if cols > 1 else (rows,)
+    if not isinstance(out, _np.ndarray):
+        raise TypeError('out has to be a numpy array. Given type was "%s"'
+                        % type(out))
+    if out.shape != shape:
+        raise ValueError('out has wrong shape %s, should be %s'
+                         % (out.shape, shape))
+    if out.dtype != dtype:
+        raise TypeError('out has wrong dtype %s, should be %s'
+                        % (out.dtype, dtype))
+    if not out.flags.writeable:
+        raise ValueError('out has to be writeable')
+    if contiguous and not out.flags.c_contiguous:
+        raise ValueError('out has to be a c-contiguous array')
+
+def _complex_stallone_array_to_ndarray(stArray, out=None):
+    """
+    converts an IComplexArray by copying its real and imaginary parts in bulk
+    into a float64 buffer, and from there into the complex128 result.
+    """
+    rows = stArray.rows()
+    cols = stArray.columns()
+    shape = (rows, cols) if cols > 1 else (rows,)
+    if out is None:
+        out = _np.empty(shape, dtype=_np.complex128)
+    else:
+        _check_out(out, stArray, _np.complex128, contiguous=False)
+
+    part = _np.empty(shape, dtype=_np.float64)
+    out.real = _copy_into(stArray.viewReal(), part)
+    out.imag = _copy_into(stArray.viewImaginary(), part)
+    return out
+
+def _complex_ndarray_to_stallone_array(pyarray):
+    """
+    converts a complex128 ndarray into an IComplexArray from its split real
+    and imaginary parts.
+    """
+    _audit_copy(pyarray.size, 'splitting complex128 into real and imaginary'
+                ' parts')
+    re = ndarray_to_stallone_array(_np.ascontiguousarray(pyarray.real))
+    im = ndarray_to_stallone_array(_np.ascontiguousarray(pyarray.imag))
+    return API.complexNew.array(re, im)
+
+def _stallone_dtype(stArray):
+    """ returns the numpy dtype corresponding to given Stallone array """
+    if isinstance(stArray, stallone.api.doubles.IDoubleArray):
+        return _np.dtype(_np.float64)
+    if isinstance(stArray, stallone.api.ints.IIntArray):
+        return _np.dtype(_np.int32)
+    raise TypeError('can only convert pystallone IDouble- or IIntArrays')
+
+def _copy_into(stArray, out):
+    """
+    copies a Stallone array into the given ndarray with a single bulk copy on
+    the java side, without intermediate python objects.
+
+    out has to be a c-contiguous float64 or int32 ndarray, which matches the
+    size of stArray.
+    """
+    target = ndarray_to_stallone_array(out, copy=False)
+    target.copyFrom(stArray)
+    return out
+
+def _flat_indices(stArray, indices):
+    """ non-negative flat indices into stArray, checked for bounds """
+    size = stArray.rows() * stArray.columns()
+    ind = _np.asarray(indices, dtype=_np.intp)
+    ind = _np.where(ind < 0, ind + size, ind)
+    if ind.size and (ind.min() < 0 or ind.max() >= size):
+        raise IndexError('index out of bounds for array of size %i' % size)
+    return ind
+
+def take(stArray, indices):
+    """
+    Gathers the elements at given indices from a Stallone array, instead of
+    calling stArray.get(i) for every index. Only rows containing indices are
+    transferred: rows close to each other are copied as one block with a
+    single bulk copy, distant ones in separate blocks.
+
+    Parameters
+    ----------
+    stArray : IDoubleArray or IIntArray
+    
+    indices : ndarray of int
+      flat (row major) indices into stArray. Negative indices count from the
+      end.
+
+    Returns
+    -------
+    ndarray of float64 or int32 with the shape of indices
+    """
+    dtype = _stallone_dtype(stArray)
+    cols = stArray.columns()
+    ind = _flat_indices(stArray, indices)
+    if not ind.size:
+        return _np.empty(ind.shape, dtype=dtype)
+
+    rows = _np.unique(ind // cols)
+    # start a new block, if copying the gap would cost more than another call
+    gap = max(1, _take_gap // cols)
+    breaks = _np.flatnonzero(_np.diff(rows) > gap) + 1
+    lo = rows[_np.append(0, breaks)]
+    hi = rows[_np.append(breaks - 1, len(rows) - 1)] + 1
+    offsets = _np.append(0, _np.cumsum(hi - lo))
+
+    data = _np.empty(offsets[-1] * cols, dtype=dtype)
+    for k in range(len(lo)):
+        block = data[offsets[k] * cols:offsets[k + 1] * cols]
+        if cols > 1:
+            block = block.reshape(-1, cols)
+        _copy_into(stArray.view(int(lo[k]), 0, int(hi[k]), cols), block)
+
+    k = _np.searchsorted(lo, ind // cols, side='right') - 1
+    return data[(offsets[k] - lo[k]) * cols + ind]
+
+def put(stArray, indices, values):
+    """
+    Scatters values to the given indices of a Stallone array, instead of
+    calling stArray.set(i, value) for every index. Consecutive indices within
+    a row are written with one bulk copy into a view of stArray; all other
+    elements are left untouched.
+
+    Parameters
+    ----------
+    stArray : IDoubleArray or IIntArray
+    
+    indices : ndarray of int
+      flat (row major) indices into stArray. Negative indices count from the
+      end. For repeated indices the last value is written.
+    
+    values : ndarray or scalar
+      values to write, broadcasted to the shape of indices.
+    """
+    dtype = _stallone_dtype(stArray)
+    cols = stArray.columns()
+    ind = _flat_indices(stArray, indices)
+    if not ind.size:
+        return
+    vals = _np.empty(ind.shape, dtype=dtype)
+    vals[...] = values
+    ind = ind.ravel()
+    vals = vals.ravel()
+
+    # sort stably and keep the last value of repeated indices
+    order = _np.argsort(ind, kind='mergesort')
+    ind = ind[order]
+    keep = _np.append(_np.diff(ind) != 0, True)
+    ind = ind[keep]
+    vals = _np.ascontiguousarray(vals[order][keep])
+
+    # runs of consecutive indices, which do not cross a row
+    breaks = _np.diff(ind) != 1
+    if cols > 1:
+        breaks |= ind[1:] % cols == 0
+    starts = _np.append(0, _np.flatnonzero(breaks) + 1)
+    stops = _np.append(starts[1:], len(ind))
+
+    for a, b in zip(starts, stops):
+        if cols > 1:
+            r, c = divmod(int(ind[a]), cols)
+            target = stArray.view(r, c, r + 1, c + int(b - a))
+            source = vals[a:b].reshape(1, -1)
+        else:
+            target = stArray.view(int(ind[a]), 0, int(ind[b - 1]) + 1, 1)
+            source = vals[a:b]
+        target.copyFrom(ndarray_to_stallone_array(source, copy=False))
+
+def _shared_array(shape, dtype, alloc):
+    from pystallone.arrays import StalloneArray
+
+    shape = tuple(shape) if hasattr(shape, '__len__') else (shape,)
+    dtype = _np.dtype(dtype)
+    if dtype == _np.float64:
+        factory = API.doublesNew
+    elif dtype == _np.int32:
+        factory = API.intsNew
+    else:
+        raise TypeError('Given type %s not mapped in stallone library' % dtype)
+    if len(shape) not in (1, 2):
+        raise ValueError('unsupported shape:', shape)
+    rows = shape[0]
+    cols = 1 if len(shape) == 1 else shape[1]
+
+    # let the jvm own the memory, if jpype exposes direct buffers to python.
+    # Java zero-fills direct buffers, so this is fine for zeros() too.
+    try:
+        jbuff = java.nio.ByteBuffer.allocateDirect(rows * cols * dtype.itemsize)
+        jbuff.order(java.nio.ByteOrder.nativeOrder())
+        base = _np.frombuffer(memoryview(jbuff), dtype=dtype).reshape(shape)
+        if not base.flags.writeable:
+            raise TypeError('read-only buffer')
+    except (TypeError, NameError):
+        # otherwise (or on python 2.6 without memoryview) allocate in numpy
+        # and hand a direct buffer to java
+        base = alloc(shape, dtype)
+        jbuff = _nio.convertToDirectBuffer(base)
+
+    return StalloneArray(factory.arrayFrom(jbuff, rows, cols), base=base)
+
+def empty(shape, dtype=_np.float64):
+    """
+    Allocates an uninitialized 1- or 2-d array, which is shared by Stallone and
+    numpy. Writes from either side are visible to the other one without a
+    copy, e.g. to let Stallone fill an output buffer.
+    
+    Parameters
+    ----------
+    shape : int or tuple of int
+    
+    dtype : numpy.float64 or numpy.int32
+    
+    Returns
+    -------
+    pystallone.arrays.StalloneArray : the IDoubleArray or IIntArray is
+    available as attribute 'stallone', the ndarray view on the same memory
+    as attribute 'base'.
+    
+    Note:
+    -----
+    The memory is kept alive by the returned object. Do not use the Stallone
+    array after the StalloneArray and all views on base have been released.
+    """
+    return _shared_array(shape, dtype, _np.empty)
+
+def zeros(shape, dtype=_np.float64):
+    """
+    Same as pystallone.empty, but the memory is initialized with zeros.
+    """
+    return _shared_array(shape, dtype, _np.zeros)
+
 # FIXME: all functions below assume, that 1d/2d arrays/lists have at least one element, which will raise in case of empty ones.
 def list1d_to_java_array(a):
     """
@@ -367,6 +779,7 @@ def jarray(a):
     if type(a) is list:
         return list_to_jarray(a)
     elif isinstance(a, _np.ndarray):
+        _audit_copy(a.size, 'conversion of ndarray to list')
         return list_to_jarray(a.tolist())
     else:
         raise TypeError("Type '%s' is not supported for conversion to java array" % type(a))
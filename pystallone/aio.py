@@ -0,0 +1,140 @@
+'''
+asyncio front-end for long running Stallone operations.
+
+Stallone calls block the calling thread until they return. The coroutines in
+this module dispatch them onto a bounded pool of threads attached to the JVM,
+so an event loop stays responsive while estimations run.
+
+Example
+-------
+>>> import pystallone
+>>> from pystallone import aio
+>>> pystallone.startJVM()
+>>> async def handle(C):
+...     Cs = await aio.to_stallone(C)
+...     T = await aio.call(pystallone.API.msm.estimateTrev, Cs)
+...     return await aio.to_ndarray(T)
+
+Cancelling an awaiting coroutine removes a call which has not yet started from
+the queue. Running calls get their Java thread interrupted; Stallone routines
+which honour Thread.interrupt() abort early, all others run to completion and
+their result is discarded.
+
+Note:
+-----
+This module requires Python 3.7 or later.
+'''
+
+import sys as _sys
+if _sys.version_info < (3, 7):
+    raise ImportError('pystallone.aio requires Python 3.7 or later')
+
+import asyncio as _asyncio
+import threading as _threading
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+
+import pystallone as _st
+
+__all__ = ['configure', 'shutdown', 'call', 'to_ndarray', 'to_stallone']
+
+""" default number of concurrently running Stallone calls """
+_max_workers = 4
+_executor = None
+_executor_lock = _threading.Lock()
+
+
+def configure(max_workers):
+    """
+    sets the maximum number of concurrently running Stallone calls. Calls
+    exceeding this bound are queued.
+
+    Parameters
+    ----------
+    max_workers : int
+        number of JVM attached threads.
+    """
+    global _max_workers
+    if max_workers < 1:
+        raise ValueError('max_workers has to be positive, given was %s'
+                         % max_workers)
+    shutdown(wait=False)
+    _max_workers = max_workers
+
+
+def shutdown(wait=True):
+    """ shuts down the executor. It is recreated on the next call. """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = _ThreadPoolExecutor(
+                _max_workers, thread_name_prefix='pystallone-aio',
+                initializer=_st._attach_thread)
+        return _executor
+
+
+class _Call(object):
+    """ callable executed in a worker thread, which can be interrupted """
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._lock = _threading.Lock()
+        self._thread = None
+        self._cancelled = False
+
+    def __call__(self):
+        with self._lock:
+            if self._cancelled:
+                raise _asyncio.CancelledError()
+            self._thread = _st.java.lang.Thread.currentThread()
+        try:
+            return self.func(*self.args, **self.kwargs)
+        finally:
+            with self._lock:
+                self._thread = None
+                # reset the interrupt flag, since the thread is reused.
+                _st.java.lang.Thread.interrupted()
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._thread is not None:
+                self._thread.interrupt()
+
+
+async def call(func, *args, **kwargs):
+    """
+    awaitable equivalent of func(*args, **kwargs), where func is a Stallone
+    method (or any callable invoking Stallone).
+
+    Returns
+    -------
+    the return value of func
+    """
+    task = _Call(func, args, kwargs)
+    loop = _asyncio.get_running_loop()
+    future = loop.run_in_executor(_get_executor(), task)
+    try:
+        return await future
+    except _asyncio.CancelledError:
+        task.cancel()
+        raise
+
+
+async def to_ndarray(stArray, **kwargs):
+    """ awaitable version of pystallone.stallone_array_to_ndarray """
+    return await call(_st.stallone_array_to_ndarray, stArray, **kwargs)
+
+
+async def to_stallone(pyarray, copy=True):
+    """ awaitable version of pystallone.ndarray_to_stallone_array """
+    return await call(_st.ndarray_to_stallone_array, pyarray, copy)
@@ -0,0 +1,349 @@
+'''
+ndarray-like access to Stallone arrays.
+
+StalloneArray wraps an IDoubleArray or IIntArray and behaves like a read-only
+ndarray: it has shape, dtype, len() and supports indexing and slicing. Only the
+accessed rows are transferred from java. If the Stallone array is backed by a
+direct buffer on numpy memory, all access is zero-copy.
+
+iter_chunks iterates over the rows of a (large) Stallone array in blocks,
+without ever materializing the whole array in python.
+
+SegmentedArray represents arrays exceeding the java limits for array lengths
+and ByteBuffer capacities (2^31) as a sequence of Stallone arrays.
+
+Example
+-------
+>>> from pystallone.arrays import StalloneArray, iter_chunks
+>>> T = StalloneArray(API.msm.estimateTrev(C)) # doctest: +SKIP
+>>> T[10:20]  # copies only rows 10 to 19 # doctest: +SKIP
+>>> for block in iter_chunks(dtraj, chunksize=10**6): # doctest: +SKIP
+...     counts += np.bincount(block, minlength=n)
+'''
+
+from multiprocessing.pool import ThreadPool as _ThreadPool
+
+import numpy as _np
+import pystallone as _st
+
+__all__ = ['StalloneArray', 'SegmentedArray', 'iter_chunks']
+
+
+class StalloneArray(object):
+    """
+    ndarray-like proxy for IDoubleArray and IIntArray.
+
+    Parameters
+    ----------
+    array : IDoubleArray, IIntArray or ndarray
+      Stallone array to wrap. If an ndarray is given, it is passed to Stallone
+      as a direct buffer (see ndarray_to_stallone_array) and all access from
+      python is a zero-copy view on it. float32 and int64 arrays are cast to
+      float64 and int32 first and the cast copy is kept as base.
+    base : (optional) ndarray
+      if array is a Stallone array backed by a direct buffer, the ndarray view
+      on the same memory.
+
+    Attributes
+    ----------
+    stallone : IDoubleArray or IIntArray
+      the wrapped Stallone array, e.g. to pass it to the Stallone API.
+    base : ndarray or None
+      memory backing the Stallone array, if it is a direct buffer.
+    """
+    def __init__(self, array, base=None):
+        if isinstance(array, _np.ndarray):
+            # cast first and keep the casted copy, java only references it
+            array = _st._cast_to_stallone_dtype(array)
+            if array.dtype not in (_np.float64, _np.int32):
+                raise TypeError('Given type %s not mapped in stallone library'
+                                % array.dtype)
+            self.stallone = _st.ndarray_to_stallone_array(array, copy=False)
+            self.base = array
+        else:
+            self.stallone = array
+            self.base = base
+        self.dtype = _st._stallone_dtype(self.stallone)
+
+        rows = self.stallone.rows()
+        cols = self.stallone.columns()
+        self.shape = (rows, cols) if cols > 1 else (rows,)
+        if self.base is not None:
+            self.base = self.base.reshape(self.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(_np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'StalloneArray(shape=%s, dtype=%s)' % (self.shape, self.dtype)
+
+    @property
+    def __array_interface__(self):
+        # only exposed for direct buffers, numpy falls back to __array__
+        if self.base is None:
+            raise AttributeError('__array_interface__')
+        return self.base.__array_interface__
+
+    def __array__(self, dtype=None, copy=None):
+        if self.base is not None:
+            a = self.base
+        else:
+            a = self._rows(0, self.shape[0])
+        if dtype is not None:
+            a = a.astype(dtype, copy=False)
+        return a
+
+    def _view(self, start, stop):
+        """ Stallone view on rows [start, stop) """
+        if start == 0 and stop == self.shape[0]:
+            return self.stallone
+        # java methods do not accept numpy integers
+        return self.stallone.view(int(start), 0, int(stop),
+                                  self.stallone.columns())
+
+    def _rows(self, start, stop):
+        """ copies rows [start, stop) into a new ndarray """
+        shape = (stop - start,) + self.shape[1:]
+        out = _np.empty(shape, dtype=self.dtype)
+        if stop <= start:
+            return out
+        return _st._copy_into(self._view(start, stop), out)
+
+    def __getitem__(self, key):
+        if self.base is not None:
+            return self.base[key]
+
+        if isinstance(key, tuple):
+            if not key:
+                return self.__array__()
+            rows, rest = key[0], key[1:]
+        else:
+            rows, rest = key, ()
+
+        if isinstance(rows, (int, _np.integer)):
+            n = self.shape[0]
+            i = rows + n if rows < 0 else rows
+            if not 0 <= i < n:
+                raise IndexError('index %i is out of bounds for axis 0 with '
+                                 'size %i' % (rows, n))
+            if self.ndim == 1:
+                result = self.stallone.get(int(i))
+                result = self.dtype.type(result)
+            else:
+                result = self._rows(i, i + 1)[0]
+        elif isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            if step == 1:
+                result = self._rows(start, max(start, stop))
+            else:
+                # copy the enclosing block of rows, then pick every step-th
+                ind = _np.arange(start, stop, step)
+                lo = ind.min() if len(ind) else 0
+                hi = ind.max() + 1 if len(ind) else 0
+                result = self._rows(lo, hi)[ind - lo]
+        else:
+            # fancy indexing, gather the rows with one bulk transfer
+            rows = _np.asarray(rows)
+            if rows.dtype == bool:
+                rows = _np.flatnonzero(rows)
+            rows = _np.where(rows < 0, rows + self.shape[0], rows)
+            if self.ndim == 1:
+                result = _st.take(self.stallone, rows)
+            else:
+                cols = self.shape[1]
+                ind = rows[..., None] * cols + _np.arange(cols)
+                result = _st.take(self.stallone, ind)
+
+        if not rest:
+            return result
+        if isinstance(rows, (int, _np.integer)):
+            return result[rest]
+        return result[(slice(None),) + rest]
+
+
+def iter_chunks(array, chunksize=65536, prefetch=True):
+    """
+    Iterates over the rows of a Stallone array in blocks of chunksize rows.
+
+    Parameters
+    ----------
+    array : IDoubleArray, IIntArray or StalloneArray
+    
+    chunksize : int
+      number of rows per block. The last block may be shorter.
+    
+    prefetch : boolean
+      if true, the next block is copied from java in a background thread,
+      while the current block is processed by the caller.
+
+    Returns
+    -------
+    generator of ndarrays with shape (chunksize,) or (chunksize, columns)
+    
+    Note:
+    -----
+    The yielded blocks are views on (at most two) reused buffers and get
+    overwritten, when the iteration advances. Copy a block, if it is needed
+    after the next iteration step.
+    """
+    if chunksize < 1:
+        raise ValueError('chunksize has to be positive, given was %s'
+                         % chunksize)
+    if not isinstance(array, StalloneArray):
+        array = StalloneArray(array)
+    n = len(array)
+
+    # direct buffers are already numpy memory
+    if array.base is not None:
+        for start in range(0, n, chunksize):
+            yield array.base[start:start + chunksize]
+        return
+
+    nchunks = (n + chunksize - 1) // chunksize
+    shape = (min(chunksize, n),) + array.shape[1:]
+    buffers = [_np.empty(shape, dtype=array.dtype)
+               for _ in range(2 if prefetch and nchunks > 1 else 1)]
+
+    def fetch(k):
+        start = k * chunksize
+        stop = min(start + chunksize, n)
+        out = buffers[k % len(buffers)][:stop - start]
+        return _st._copy_into(array._view(start, stop), out)
+
+    if len(buffers) == 1:
+        for k in range(nchunks):
+            yield fetch(k)
+        return
+
+    pool = _ThreadPool(1, initializer=_st._attach_thread)
+    try:
+        pending = pool.apply_async(fetch, (0,))
+        for k in range(nchunks):
+            block = pending.get()
+            # the consumer is done with the other buffer, fill it meanwhile
+            if k + 1 < nchunks:
+                pending = pool.apply_async(fetch, (k + 1,))
+            yield block
+    finally:
+        pool.terminate()
+
+
+class SegmentedArray(object):
+    """
+    1- or 2-d array split along its rows into several Stallone arrays, each
+    within the java limits of 2^31 elements (copy=True) or bytes (copy=False).
+
+    Parameters
+    ----------
+    pyarray : ndarray
+      float64 or int32 array to convert.
+    copy : boolean
+      see ndarray_to_stallone_array. For copy=False, pyarray has to be
+      c-contiguous and the segments are direct buffers on its memory.
+    max_segment_rows : (optional) int
+      maximum number of rows per segment. Defaults to the largest number
+      allowed by java.
+
+    Attributes
+    ----------
+    segments : list of IDoubleArray or IIntArray
+    offsets : ndarray
+      index of the first row of every segment, followed by the total number
+      of rows.
+    """
+    def __init__(self, pyarray, copy=False, max_segment_rows=None):
+        if not isinstance(pyarray, _np.ndarray):
+            raise TypeError('Only numpy arrays supported. Given type was "%s"'
+                            % type(pyarray))
+        if pyarray.dtype not in (_np.float64, _np.int32):
+            raise TypeError('Given type %s not mapped in stallone library'
+                            % pyarray.dtype)
+        if pyarray.ndim not in (1, 2):
+            raise ValueError('unsupported shape:', pyarray.shape)
+
+        self.shape = pyarray.shape
+        self.dtype = pyarray.dtype
+        n = self.shape[0]
+        row_size = 1 if pyarray.ndim == 1 else self.shape[1]
+        row_bytes = row_size * self.dtype.itemsize
+        limit = _st._max_java_length // (row_size if copy else row_bytes)
+        if limit < 1:
+            raise ValueError('a single row exceeds the java array limits')
+        if max_segment_rows is None or max_segment_rows > limit:
+            max_segment_rows = limit
+
+        self.offsets = _np.append(_np.arange(0, n, max_segment_rows), n)
+        self.segments = [_st.ndarray_to_stallone_array(pyarray[start:stop],
+                                                       copy=copy)
+                         for start, stop in zip(self.offsets[:-1],
+                                                self.offsets[1:])]
+        # keep the memory the direct buffers point to alive
+        self.base = None if copy else pyarray
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'SegmentedArray(shape=%s, dtype=%s, segments=%i)' \
+            % (self.shape, self.dtype, len(self.segments))
+
+    def locate(self, i):
+        """
+        maps the (possibly negative) row index i to the tuple
+        (segment number, row in segment).
+        """
+        n = self.shape[0]
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('index %i is out of bounds for axis 0 with size %i'
+                             % (i, n))
+        k = _np.searchsorted(self.offsets, i, side='right') - 1
+        return int(k), int(i - self.offsets[k])
+
+    def get(self, i, j=None):
+        """ returns element i (1-d) or element (i, j) (2-d) """
+        k, row = self.locate(i)
+        if j is None:
+            return self.segments[k].get(row)
+        return self.segments[k].get(row, j)
+
+    def to_java_list(self):
+        """ returns the segments as java.util.List, e.g. for Stallone methods
+        accepting multiple trajectories. """
+        return _st.list_to_java_list(self.segments)
+
+    def to_ndarray(self, out=None):
+        """
+        copies all segments into one ndarray, segment by segment.
+
+        Parameters
+        ----------
+        out : (optional) ndarray
+          c-contiguous array of matching shape and dtype to fill.
+        """
+        if out is None:
+            out = _np.empty(self.shape, dtype=self.dtype)
+        elif out.shape != self.shape:
+            raise ValueError('out has wrong shape %s, should be %s'
+                             % (out.shape, self.shape))
+        for seg, start, stop in zip(self.segments, self.offsets[:-1],
+                                    self.offsets[1:]):
+            block = out[start:stop]
+            if block.ndim == 2 and block.shape[1] == 1:
+                # single columns are converted as 1-d arrays
+                block = block.reshape(-1)
+            _st.stallone_array_to_ndarray(seg, out=block)
+        return out
@@ -0,0 +1,361 @@
+'''
+Streaming clustering of trajectory data.
+
+The clustering classes in this module process data chunk by chunk, so data
+sets larger than memory (e.g. lists of numpy memmaps) can be discretized.
+Cluster centers are exposed to Stallone as a direct buffer, so they can be
+passed to the Stallone API without a copy.
+
+Example
+-------
+>>> from pystallone.cluster import KMeans
+>>> trajs = [np.load(f, mmap_mode='r') for f in files] # doctest: +SKIP
+>>> km = KMeans(100, batch_size=10000).fit(trajs) # doctest: +SKIP
+>>> km.stallone_centers # IDoubleArray of shape (100, dim) # doctest: +SKIP
+'''
+
+import threading as _threading
+import time as _time
+from multiprocessing import cpu_count as _cpu_count
+from multiprocessing.pool import ThreadPool as _ThreadPool
+
+import numpy as _np
+import pystallone as _st
+
+__all__ = ['RegularSpaceClustering', 'KMeans', 'assign_batch']
+
+""" default number of frames per chunk """
+_chunksize = 65536
+
+
+def _iter_chunks(data, chunksize):
+    """
+    yields 2-d float64 chunks of data, which is an ndarray (or memmap), a list
+    of those, or an iterable of chunks.
+    """
+    if isinstance(data, _np.ndarray):
+        data = [data]
+    for traj in data:
+        traj = _np.asarray(traj)
+        if traj.ndim == 1:
+            traj = traj[:, None]
+        for start in range(0, len(traj), chunksize):
+            yield _np.asarray(traj[start:start + chunksize], dtype=_np.float64)
+
+
+def _sqdist(X, centers):
+    """ squared euclidean distances between rows of X and centers """
+    d = _np.dot(X, centers.T)
+    d *= -2
+    d += _np.einsum('ij,ij->i', X, X)[:, None]
+    d += _np.einsum('ij,ij->i', centers, centers)[None, :]
+    return d
+
+
+def _assign(X, centers, out=None):
+    """ index of the nearest center for every row of X """
+    d = _sqdist(X, centers)
+    return _np.argmin(d, axis=1, out=out)
+
+
+class _Clustering(object):
+
+    centers = None
+
+    @property
+    def stallone_centers(self):
+        """
+        cluster centers as IDoubleArray of shape (n_centers, dim), sharing
+        memory with the centers attribute.
+        """
+        if self.centers is None:
+            raise RuntimeError('clustering has not been fitted yet')
+        return _st.ndarray_to_stallone_array(self.centers, copy=False)
+
+    def assign(self, X):
+        """
+        Returns the index of the nearest center for every frame of X as int32
+        ndarray.
+        """
+        X = _np.asarray(X)
+        out = _np.empty(len(X), dtype=_np.int32)
+        chunksize = self.chunksize
+        for start, chunk in zip(range(0, len(X), chunksize),
+                                _iter_chunks(X, chunksize)):
+            out[start:start + len(chunk)] = _assign(chunk, self.centers)
+        return out
+
+
+class RegularSpaceClustering(_Clustering):
+    """
+    Regular space clustering: a frame becomes a new center, if its distance
+    to all existing centers exceeds dmin. Needs a single pass over the data.
+
+    Parameters
+    ----------
+    dmin : float
+      minimum distance between centers.
+    max_centers : int
+      the clustering raises a RuntimeError, if more centers are created.
+    chunksize : int
+      number of frames processed at once.
+    """
+    def __init__(self, dmin, max_centers=10000, chunksize=_chunksize):
+        self.dmin = float(dmin)
+        self.max_centers = max_centers
+        self.chunksize = chunksize
+        self.centers = None
+
+    def partial_fit(self, X):
+        """ updates the centers with the frames of chunk X """
+        X = _np.asarray(X, dtype=_np.float64)
+        if X.ndim == 1:
+            X = X[:, None]
+        if not len(X):
+            return self
+        if self.centers is None:
+            self.centers = X[:1].copy()
+        dmin2 = self.dmin**2
+
+        # only frames far from all existing centers can become centers
+        far = _np.flatnonzero(_sqdist(X, self.centers).min(axis=1) > dmin2)
+        new = []
+        for i in far:
+            if new and ((X[new] - X[i])**2).sum(axis=1).min() <= dmin2:
+                continue
+            new.append(i)
+        if len(self.centers) + len(new) > self.max_centers:
+            raise RuntimeError('more than max_centers=%i centers. Increase '
+                               'dmin or max_centers.' % self.max_centers)
+        if new:
+            self.centers = _np.vstack((self.centers, X[new]))
+        return self
+
+    def fit(self, data):
+        """
+        clusters data, which is an ndarray, memmap, list of those or an
+        iterable of chunks.
+        """
+        for chunk in _iter_chunks(data, self.chunksize):
+            self.partial_fit(chunk)
+        return self
+
+
+class KMeans(_Clustering):
+    """
+    k-means clustering over chunked data.
+
+    Parameters
+    ----------
+    k : int
+      number of clusters.
+    max_iter : int
+      maximum number of passes over the data in fit.
+    tol : float
+      fit stops, when no center moves further than tol.
+    batch_size : (optional) int
+      if given, mini-batch k-means is used: centers are updated after every
+      batch of this size, which converges in very few passes.
+    chunksize : int
+      number of frames processed at once (if batch_size is not given).
+    seed : (optional) int
+      seed for the choice of initial centers.
+    """
+    def __init__(self, k, max_iter=10, tol=1e-5, batch_size=None,
+                 chunksize=_chunksize, seed=None):
+        self.k = k
+        self.max_iter = max_iter
+        self.tol = tol
+        self.batch_size = batch_size
+        self.chunksize = batch_size or chunksize
+        self._random = _np.random.RandomState(seed)
+        self.centers = None
+        self._counts = None
+
+    def _init_centers(self, X):
+        if len(X) < self.k:
+            raise ValueError('first chunk contains %i frames, at least k=%i '
+                             'are needed for initialization.'
+                             % (len(X), self.k))
+        ind = self._random.choice(len(X), self.k, replace=False)
+        self.centers = X[ind].copy()
+        self._counts = _np.zeros(self.k)
+
+    def partial_fit(self, X):
+        """ mini-batch update of the centers with chunk X """
+        X = _np.asarray(X, dtype=_np.float64)
+        if X.ndim == 1:
+            X = X[:, None]
+        if self.centers is None:
+            self._init_centers(X)
+        labels = _assign(X, self.centers)
+        n = _np.bincount(labels, minlength=self.k).astype(_np.float64)
+        sums = _np.zeros_like(self.centers)
+        _np.add.at(sums, labels, X)
+        # per center learning rate 1 / (number of frames seen)
+        self._counts += n
+        hit = n > 0
+        self.centers[hit] += (sums[hit] - n[hit, None] * self.centers[hit]) \
+            / self._counts[hit, None]
+        return self
+
+    def fit(self, data):
+        """
+        clusters data, which is an ndarray, memmap or list of those. Lists are
+        iterated up to max_iter times.
+
+        One-shot iterables of chunks (e.g. generators) can not be iterated
+        again, so their chunks are used for a single pass of mini-batch
+        updates.
+        """
+        if iter(data) is data:
+            for chunk in _iter_chunks(data, self.chunksize):
+                self.partial_fit(chunk)
+            if self.centers is None:
+                raise ValueError('no data given')
+            return self
+
+        for _ in range(self.max_iter):
+            old = None if self.centers is None else self.centers.copy()
+            if self.batch_size:
+                for chunk in _iter_chunks(data, self.chunksize):
+                    self.partial_fit(chunk)
+            else:
+                self._lloyd_step(data)
+            if old is not None and \
+                    _np.sqrt(((self.centers - old)**2).sum(axis=1)).max() \
+                    <= self.tol:
+                break
+        return self
+
+    def _lloyd_step(self, data):
+        sums = None
+        n = None
+        for chunk in _iter_chunks(data, self.chunksize):
+            if self.centers is None:
+                self._init_centers(chunk)
+            if sums is None:
+                sums = _np.zeros_like(self.centers)
+                n = _np.zeros(self.k)
+            labels = _assign(chunk, self.centers)
+            n += _np.bincount(labels, minlength=self.k)
+            _np.add.at(sums, labels, chunk)
+        if n is None:
+            raise ValueError('no data given')
+        # empty clusters keep their center
+        hit = n > 0
+        self.centers[hit] = sums[hit] / n[hit, None]
+
+
+def assign_batch(centers, trajs, out=None, n_jobs=None, chunksize=_chunksize,
+                 return_throughput=False):
+    """
+    Assigns all frames of many trajectories to their nearest cluster center.
+
+    The trajectories are split into chunks, which are assigned concurrently by
+    a pool of threads (numpy releases the GIL for the distance computations).
+    At most 2 * n_jobs chunks are pending at any time, so chunk iterators are
+    streamed.
+
+    Parameters
+    ----------
+    centers : ndarray, IDoubleArray or StalloneArray of shape (k, dim)
+    
+    trajs : list
+      trajectories of shape (n_frames, dim), each an ndarray, a memmap or an
+      iterable of chunks.
+    out : (optional) list of ndarrays
+      int32 arrays (or memmaps) of length n_frames to write the assignments
+      to. Entries may be None.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+    chunksize : int
+      number of frames per task.
+    return_throughput : boolean
+      if true, the number of assigned frames per second is returned as well.
+
+    Returns
+    -------
+    list of int32 ndarrays, and the throughput in frames per second if
+    return_throughput is true.
+    """
+    if hasattr(centers, 'getArray'):
+        # IDoubleArray
+        centers = _st.stallone_array_to_ndarray(centers)
+    centers = _np.asarray(centers, dtype=_np.float64)
+    if centers.ndim == 1:
+        centers = centers[:, None]
+    if out is None:
+        out = [None] * len(trajs)
+    if len(out) != len(trajs):
+        raise ValueError('got %i output arrays for %i trajectories'
+                         % (len(out), len(trajs)))
+    out = list(out)
+    for i, traj in enumerate(trajs):
+        if out[i] is None and hasattr(traj, 'shape'):
+            out[i] = _np.empty(len(traj), dtype=_np.int32)
+        elif out[i] is not None and hasattr(traj, 'shape') \
+                and out[i].shape != (len(traj),):
+            raise ValueError('output array %i has shape %s, should be %s'
+                             % (i, out[i].shape, (len(traj),)))
+
+    def tasks():
+        for i, traj in enumerate(trajs):
+            if hasattr(traj, 'shape'):
+                for start in range(0, len(traj), chunksize):
+                    yield i, start, traj[start:start + chunksize]
+            else:
+                start = 0
+                for chunk in traj:
+                    yield i, start, chunk
+                    start += len(chunk)
+
+    def work(task):
+        i, start, chunk = task
+        X = _np.asarray(chunk, dtype=_np.float64)
+        if X.ndim == 1:
+            X = X[:, None]
+        labels = _assign(X, centers).astype(_np.int32)
+        if out[i] is not None:
+            out[i][start:start + len(labels)] = labels
+            return i, start, None
+        return i, start, labels
+
+    # bound the number of chunks in memory, chunk iterators are only
+    # advanced as fast as the threads assign their chunks
+    n_jobs = n_jobs or _cpu_count()
+    slots = _threading.BoundedSemaphore(2 * n_jobs)
+
+    def run(task):
+        try:
+            return work(task)
+        finally:
+            slots.release()
+
+    t0 = _time.time()
+    pieces = {}
+    pool = _ThreadPool(n_jobs)
+    try:
+        results = []
+        for task in tasks():
+            slots.acquire()
+            results.append(pool.apply_async(run, (task,)))
+        for r in results:
+            i, start, labels = r.get()
+            if labels is not None:
+                pieces.setdefault(i, []).append((start, labels))
+    finally:
+        pool.terminate()
+
+    # chunk iterators without preallocated output
+    for i, p in pieces.items():
+        p.sort(key=lambda x: x[0])
+        out[i] = _np.concatenate([labels for _, labels in p])
+    for i in range(len(out)):
+        if out[i] is None:
+            out[i] = _np.empty(0, dtype=_np.int32)
+
+    if not return_throughput:
+        return out
+    n_frames = sum(len(o) for o in out)
+    return out, n_frames / max(_time.time() - t0, 1e-9)
@@ -0,0 +1,313 @@
+'''
+Coordinate transformations (PCA, TICA) on chunked trajectory data.
+
+CovarianceAccumulator collects mean, covariance and time-lagged covariance
+from chunks with numerically stable online updates. Accumulators of
+different workers (e.g. pystallone.pool processes working on different files)
+can be merged.
+
+pca and tica estimate a LinearTransform from an accumulator, project_batch
+applies it to many trajectories, writing into preallocated arrays or .npy
+files.
+
+Example
+-------
+>>> from pystallone.coor import CovarianceAccumulator, tica, project_batch
+>>> acc = CovarianceAccumulator(lag=10)
+>>> for traj in trajs: # doctest: +SKIP
+...     acc.add_trajectory(np.load(traj, mmap_mode='r'))
+>>> acc.cov, acc.cov_tau # doctest: +SKIP
+>>> project_batch(tica(acc), trajs, dim=2, out=['%i.npy' % i for i in ...])
+... # doctest: +SKIP
+'''
+
+from multiprocessing.pool import ThreadPool as _ThreadPool
+
+import numpy as _np
+import pystallone as _st
+
+__all__ = ['CovarianceAccumulator', 'LinearTransform', 'pca', 'tica',
+           'project_batch']
+
+""" default number of frames per chunk """
+_chunksize = 65536
+
+
+def _moments(X, Y):
+    """ number of frames, means and centered cross product matrix """
+    mx = X.mean(axis=0)
+    my = Y.mean(axis=0)
+    M = _np.dot((X - mx).T, Y - my)
+    return len(X), mx, my, M
+
+
+def _combine(a, b):
+    """
+    combines the moments of two disjoint data sets (Chan et al., pairwise
+    update), which is stable also for large offsets of the means.
+    """
+    na, mxa, mya, Ma = a
+    nb, mxb, myb, Mb = b
+    if na == 0:
+        return b
+    if nb == 0:
+        return a
+    n = na + nb
+    dx = mxb - mxa
+    dy = myb - mya
+    mx = mxa + dx * (float(nb) / n)
+    my = mya + dy * (float(nb) / n)
+    M = Ma + Mb + _np.outer(dx, dy) * (float(na) * nb / n)
+    return n, mx, my, M
+
+
+class CovarianceAccumulator(object):
+    """
+    Online estimator of mean, covariance and time-lagged covariance.
+
+    Parameters
+    ----------
+    lag : int
+      lag time in frames for the time-lagged covariance. 0 accumulates only
+      the instantaneous statistics (e.g. for PCA).
+
+    Attributes
+    ----------
+    n : int
+      number of frames seen.
+    mean : ndarray
+      mean of all frames.
+    cov : ndarray
+      covariance matrix of all frames.
+    n_tau : int
+      number of time-lagged frame pairs seen.
+    cov_tau : ndarray
+      time-lagged covariance between x_t and x_t+lag.
+    """
+    def __init__(self, lag=0):
+        if lag < 0:
+            raise ValueError('lag has to be non-negative, given was %s' % lag)
+        self.lag = lag
+        self._instantaneous = (0, None, None, None)
+        self._lagged = (0, None, None, None)
+        self._tail = None
+
+    def add(self, X, new_trajectory=True):
+        """
+        adds a chunk of frames.
+
+        Parameters
+        ----------
+        X : ndarray of shape (n_frames, dim)
+
+        new_trajectory : boolean
+          if false, X continues the trajectory of the previous chunk, so
+          time-lagged pairs spanning both chunks are counted.
+        """
+        X = _np.asarray(X, dtype=_np.float64)
+        if X.ndim == 1:
+            X = X[:, None]
+        if not len(X):
+            return self
+        self._instantaneous = _combine(self._instantaneous,
+                                       _moments(X, X))
+        if self.lag == 0:
+            return self
+
+        if new_trajectory or self._tail is None:
+            Z = X
+        else:
+            Z = _np.vstack((self._tail, X))
+        if len(Z) > self.lag:
+            self._lagged = _combine(self._lagged,
+                                    _moments(Z[:-self.lag], Z[self.lag:]))
+        self._tail = Z[-self.lag:].copy()
+        return self
+
+    def add_trajectory(self, traj, chunksize=_chunksize):
+        """ adds a whole trajectory (e.g. a memmap) chunk by chunk """
+        for start in range(0, len(traj), chunksize):
+            self.add(traj[start:start + chunksize], new_trajectory=start == 0)
+        return self
+
+    def merge(self, other):
+        """
+        adds the statistics of another accumulator with the same lag, e.g.
+        computed by a parallel worker on different trajectories.
+        """
+        if other.lag != self.lag:
+            raise ValueError('can not merge accumulators of lag %i and %i'
+                             % (self.lag, other.lag))
+        self._instantaneous = _combine(self._instantaneous,
+                                       other._instantaneous)
+        self._lagged = _combine(self._lagged, other._lagged)
+        self._tail = None
+        return self
+
+    @property
+    def n(self):
+        return self._instantaneous[0]
+
+    @property
+    def mean(self):
+        return self._instantaneous[1]
+
+    @property
+    def cov(self):
+        n, _, _, M = self._instantaneous
+        return None if M is None else M / max(n - 1, 1)
+
+    @property
+    def n_tau(self):
+        return self._lagged[0]
+
+    @property
+    def cov_tau(self):
+        n, _, _, M = self._lagged
+        return None if M is None else M / max(n - 1, 1)
+
+    def stallone_cov(self):
+        """
+        returns (cov, cov_tau) as IDoubleArrays for the Stallone API. cov_tau
+        is None for lag 0.
+        """
+        # copy, since the ndarrays are temporaries
+        cov = _st.ndarray_to_stallone_array(self.cov)
+        if self.lag == 0:
+            return cov, None
+        return cov, _st.ndarray_to_stallone_array(self.cov_tau)
+
+
+class LinearTransform(object):
+    """
+    Projection y = (x - mean) * components onto the leading components.
+
+    Attributes
+    ----------
+    mean : ndarray of shape (dim_in,)
+    components : ndarray of shape (dim_in, n_components)
+      columns sorted by decreasing eigenvalue.
+    eigenvalues : ndarray of shape (n_components,)
+    """
+    def __init__(self, mean, components, eigenvalues):
+        self.mean = mean
+        self.components = components
+        self.eigenvalues = eigenvalues
+
+    def transform(self, X, dim=None, out=None):
+        """
+        projects the frames X onto the leading dim components (all, if dim is
+        None). The result is written to out, if given.
+        """
+        V = self.components if dim is None else self.components[:, :dim]
+        Y = _np.dot(_np.asarray(X, dtype=_np.float64) - self.mean, V)
+        if out is None:
+            return Y
+        out[...] = Y
+        return out
+
+
+def _sorted_eigh(A):
+    """ eigenvalues and -vectors of symmetric A by decreasing eigenvalue """
+    ev, V = _np.linalg.eigh(A)
+    order = _np.argsort(ev)[::-1]
+    return ev[order], V[:, order]
+
+
+def pca(acc):
+    """
+    Estimates principal components from the covariance of a
+    CovarianceAccumulator.
+    """
+    ev, V = _sorted_eigh(acc.cov)
+    return LinearTransform(acc.mean, V, ev)
+
+
+def tica(acc, epsilon=1e-6):
+    """
+    Estimates time-lagged independent components from a CovarianceAccumulator
+    with lag > 0, by solving the generalized eigenvalue problem
+    C_tau v = lambda C_0 v with the symmetrized time-lagged covariance.
+
+    Parameters
+    ----------
+    epsilon : float
+      directions with covariance eigenvalues below epsilon are discarded
+      (they are not resolved by the data).
+    """
+    if acc.lag == 0 or acc.cov_tau is None:
+        raise ValueError('tica needs an accumulator with lag > 0 and data')
+    # whiten with respect to the instantaneous covariance
+    s, U = _sorted_eigh(acc.cov)
+    keep = s > epsilon
+    W = U[:, keep] / _np.sqrt(s[keep])
+    C_tau = 0.5 * (acc.cov_tau + acc.cov_tau.T)
+    ev, V = _sorted_eigh(_np.dot(W.T, _np.dot(C_tau, W)))
+    return LinearTransform(acc.mean, _np.dot(W, V), ev)
+
+
+def project_batch(transform, trajs, dim, out=None, n_jobs=None,
+                  chunksize=_chunksize):
+    """
+    Projects many trajectories onto the leading dim components.
+
+    The trajectories are processed chunk by chunk by a pool of threads (numpy
+    releases the GIL for the projections), so no full-size intermediate
+    arrays are created.
+
+    Parameters
+    ----------
+    transform : LinearTransform
+    
+    trajs : list of ndarrays (or memmaps) of shape (n_frames, dim_in)
+    
+    dim : int
+      number of leading components to project on.
+    out : (optional) list
+      outputs for every trajectory: an ndarray (or memmap) of shape
+      (n_frames, dim), a filename to create as .npy memmap, or None to
+      allocate a float64 ndarray.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+
+    Returns
+    -------
+    list of ndarrays (memmaps for given filenames)
+    """
+    if out is None:
+        out = [None] * len(trajs)
+    if len(out) != len(trajs):
+        raise ValueError('got %i outputs for %i trajectories'
+                         % (len(out), len(trajs)))
+    results = []
+    for traj, o in zip(trajs, out):
+        shape = (len(traj), dim)
+        if o is None:
+            o = _np.empty(shape)
+        elif isinstance(o, str):
+            o = _np.lib.format.open_memmap(o, mode='w+', dtype=_np.float64,
+                                           shape=shape)
+        elif o.shape != shape:
+            raise ValueError('output has shape %s, should be %s'
+                             % (o.shape, shape))
+        results.append(o)
+
+    tasks = [(i, start) for i, traj in enumerate(trajs)
+             for start in range(0, len(traj), chunksize)]
+
+    def work(task):
+        i, start = task
+        stop = start + chunksize
+        transform.transform(trajs[i][start:stop], dim,
+                            out=results[i][start:stop])
+
+    pool = _ThreadPool(n_jobs)
+    try:
+        pool.map(work, tasks)
+    finally:
+        pool.terminate()
+
+    for o in results:
+        if isinstance(o, _np.memmap):
+            o.flush()
+    return results
@@ -0,0 +1,558 @@
+'''
+Hidden Markov model estimation on ragged lists of observation arrays.
+
+HMM estimates a hidden Markov model with discrete (int observations) or
+gaussian (float observations) outputs by Baum-Welch.
+
+By default, the estimation runs in Stallone (API.hmmNew / API.hmm). The
+observations are passed once as views on a single direct buffer, and only
+the estimated parameters and the Viterbi paths are copied back to numpy.
+
+With engine='numpy' the same estimator runs in python. Its forward/backward
+and Viterbi recursions are vectorized across trajectories: the trajectories
+are stored time-major, so every time step is a single numpy operation on all
+trajectories which are long enough. Groups of trajectories can be processed
+by spawned worker processes (n_jobs, Python 3 only), which receive their
+group once and per iteration only the model parameters. Scripts using them
+need an ``if __name__ == '__main__':`` guard.
+
+Example
+-------
+>>> from pystallone.hmm import HMM
+>>> hmm = HMM(2).fit([np.load(f) for f in files]) # doctest: +SKIP
+>>> hmm.transition_matrix, hmm.output_probabilities # doctest: +SKIP
+>>> paths = hmm.viterbi() # doctest: +SKIP
+'''
+
+import multiprocessing as _mp
+
+import numpy as _np
+import pystallone as _st
+
+__all__ = ['Observations', 'HMM']
+
+
+class Observations(object):
+    """
+    Ragged list of observation trajectories in one contiguous buffer.
+
+    Parameters
+    ----------
+    trajs : ndarray or list of 1-d ndarrays
+      int arrays are discrete observations (converted to int32), float
+      arrays gaussian observations (converted to float64).
+
+    Attributes
+    ----------
+    data : ndarray
+      all trajectories concatenated.
+    offsets : ndarray
+      index of the first frame of every trajectory, followed by the total
+      number of frames.
+    discrete : boolean
+      whether the observations are discrete.
+    stallone : java.util.List
+      views on data, one IIntArray or IDoubleArray per non-empty
+      trajectory. Created on first access, data is not copied.
+    """
+    def __init__(self, trajs):
+        if isinstance(trajs, _np.ndarray):
+            trajs = [trajs]
+        trajs = [_np.asarray(t) for t in trajs]
+        if not trajs:
+            raise ValueError('no observations given')
+        for t in trajs:
+            if t.ndim != 1:
+                raise ValueError('observation trajectories have to be 1-d, '
+                                 'given shape was %s' % (t.shape,))
+        self.discrete = all(_np.issubdtype(t.dtype, _np.integer)
+                            for t in trajs)
+        dtype = _np.int32 if self.discrete else _np.float64
+        self.data = _np.concatenate(trajs).astype(dtype, copy=False)
+        self.offsets = _np.append(0, _np.cumsum([len(t) for t in trajs]))
+        if self.discrete and len(self.data) and self.data.min() < 0:
+            raise ValueError('discrete observations have to be non-negative')
+        self._stallone = None
+
+    @property
+    def stallone(self):
+        if self._stallone is None:
+            # data stays referenced by self, as long as the views are used
+            buff = _st.ndarray_to_stallone_array(self.data, copy=False)
+            trajs = _st.java.util.ArrayList()
+            for a, b in zip(self.offsets[:-1], self.offsets[1:]):
+                if b > a:
+                    trajs.add(buff.view(int(a), 0, int(b), 1))
+            self._stallone = trajs
+        return self._stallone
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """ view on trajectory i """
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class _Packed(object):
+    """
+    time-major layout of trajectories: sorted by decreasing length, the
+    trajectories still running at time t are a prefix, and their frames t
+    are the rows offsets[t] to offsets[t + 1] of data.
+    """
+    def __init__(self, trajs):
+        lengths = _np.array([len(t) for t in trajs], dtype=_np.intp)
+        self.order = _np.argsort(-lengths, kind='mergesort')
+        lengths = lengths[self.order]
+        n = lengths[0] if len(lengths) else 0
+        # number of trajectories running at time t
+        self.active = len(lengths) - _np.searchsorted(lengths[::-1],
+                                                      _np.arange(n),
+                                                      side='right')
+        self.offsets = _np.append(0, _np.cumsum(self.active))
+        self.rows = [self.offsets[:length] + j
+                     for j, length in enumerate(lengths)]
+        dtype = trajs[0].dtype if len(trajs) else _np.float64
+        self.data = _np.empty(self.offsets[-1], dtype=dtype)
+        for j, i in enumerate(self.order):
+            self.data[self.rows[j]] = trajs[i]
+        # row of frame t - 1 for all rows of times t >= 1
+        t = _np.repeat(_np.arange(1, n), self.active[1:])
+        self.previous = _np.arange(self.offsets[1] if n else 0,
+                                   self.offsets[-1]) \
+            - self.offsets[t] + self.offsets[t - 1]
+
+    def unpack(self, x):
+        """ splits packed rows x into a list in the original order """
+        result = [None] * len(self.order)
+        for j, i in enumerate(self.order):
+            result[i] = x[self.rows[j]]
+        return result
+
+
+def _output_probabilities(discrete, emission, data):
+    """ output probabilities of all frames, (n_frames, nstates) """
+    if discrete:
+        return _np.ascontiguousarray(emission[:, data].T)
+    means, variances = emission
+    d = data[:, None] - means
+    return _np.exp(-0.5 * d**2 / variances) / _np.sqrt(2 * _np.pi * variances)
+
+
+def _forward_backward(A, p0, B, packed):
+    """
+    scaled forward/backward pass for the packed output probabilities B.
+    Returns the log likelihood, the state probabilities gamma and the summed
+    transition probabilities xi.
+    """
+    offsets = packed.offsets
+    alpha = _np.empty_like(B)
+    c = _np.empty(len(B))
+    for t in range(len(packed.active)):
+        lo, hi = offsets[t], offsets[t + 1]
+        if t:
+            a = _np.dot(alpha[offsets[t - 1]:offsets[t - 1] + hi - lo], A)
+            a *= B[lo:hi]
+        else:
+            a = p0 * B[lo:hi]
+        c[lo:hi] = a.sum(axis=1)
+        alpha[lo:hi] = a / c[lo:hi, None]
+
+    # trajectories ending at t keep beta = 1
+    beta = _np.ones_like(B)
+    for t in range(len(packed.active) - 2, -1, -1):
+        lo, hi = offsets[t + 1], offsets[t + 2]
+        start = offsets[t]
+        beta[start:start + hi - lo] = _np.dot(
+            B[lo:hi] * beta[lo:hi] / c[lo:hi, None], A.T)
+
+    gamma = alpha * beta
+    gamma /= gamma.sum(axis=1)[:, None]
+    later = (B * beta / c[:, None])[offsets[1]:]
+    xi = _np.dot(alpha[packed.previous].T, later) * A
+    return _np.log(c).sum(), gamma, xi
+
+
+def _estep(args):
+    """ E-step for a group of packed trajectories """
+    A, p0, discrete, emission, packed = args
+    B = _output_probabilities(discrete, emission, packed.data)
+    logl, gamma, xi = _forward_backward(A, p0, B, packed)
+    if discrete:
+        K = emission.shape[1]
+        stats = _np.vstack([_np.bincount(packed.data, weights=gamma[:, i],
+                                         minlength=K)
+                            for i in range(gamma.shape[1])])
+    else:
+        stats = _np.vstack((gamma.sum(axis=0), _np.dot(packed.data, gamma),
+                            _np.dot(packed.data**2, gamma)))
+    return logl, gamma[:packed.offsets[1]].sum(axis=0), xi, stats
+
+
+def _viterbi(args):
+    """ most likely hidden paths for a group of packed trajectories """
+    A, p0, discrete, emission, packed = args
+    B = _output_probabilities(discrete, emission, packed.data)
+    offsets = packed.offsets
+    active = _np.append(packed.active, 0)
+    with _np.errstate(divide='ignore'):
+        logA = _np.log(A)
+        logB = _np.log(B)
+        delta = _np.log(p0) + logB[:offsets[1]]
+    psi = _np.zeros(B.shape, dtype=_np.int32)
+    # final state of every trajectory
+    last = _np.empty(len(packed.order), dtype=_np.int32)
+    for t in range(len(packed.active)):
+        lo, hi = offsets[t], offsets[t + 1]
+        if t:
+            scores = delta[:hi - lo, :, None] + logA
+            psi[lo:hi] = _np.argmax(scores, axis=1)
+            delta = scores.max(axis=1) + logB[lo:hi]
+        last[active[t + 1]:active[t]] = _np.argmax(
+            delta[active[t + 1]:active[t]], axis=1)
+
+    path = _np.empty(len(B), dtype=_np.int32)
+    state = _np.empty(len(packed.order), dtype=_np.int32)
+    for t in range(len(packed.active) - 1, -1, -1):
+        lo, hi = offsets[t], offsets[t + 1]
+        state[active[t + 1]:active[t]] = last[active[t + 1]:active[t]]
+        path[lo:hi] = state[:hi - lo]
+        if t:
+            state[:hi - lo] = psi[lo:hi][_np.arange(hi - lo), state[:hi - lo]]
+    return packed.unpack(path)
+
+
+def _groups(lengths, n):
+    """ splits trajectory indices into at most n groups of similar size """
+    groups = [[] for _ in range(n)]
+    sizes = _np.zeros(n)
+    for i in _np.argsort(lengths)[::-1]:
+        k = _np.argmin(sizes)
+        groups[k].append(i)
+        sizes[k] += lengths[i]
+    return [g for g in groups if g]
+
+
+def _serve(conn, packed):
+    """ worker process: evaluates tasks on its packed group until None """
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        func, parameters = task
+        try:
+            result = func(parameters + (packed,))
+        except Exception as e:
+            result = e
+        conn.send(result)
+    conn.close()
+
+
+class _Workers(object):
+    """
+    one spawned process per packed group, which receives its group only
+    once. Every call sends just the function and the model parameters. A
+    single group is evaluated in the calling process.
+    """
+    def __init__(self, groups):
+        self.groups = groups
+        self.processes = []
+        self.connections = []
+        if len(groups) < 2:
+            return
+        # the JVM of this process does not survive a fork
+        ctx = _mp.get_context('spawn')
+        try:
+            for g in groups:
+                parent, child = ctx.Pipe()
+                process = ctx.Process(target=_serve, args=(child, g))
+                process.daemon = True
+                process.start()
+                child.close()
+                self.processes.append(process)
+                self.connections.append(parent)
+        except:
+            self.close()
+            raise
+
+    def map(self, func, parameters):
+        if not self.processes:
+            return [func(parameters + (g,)) for g in self.groups]
+        for conn in self.connections:
+            conn.send((func, parameters))
+        results = [conn.recv() for conn in self.connections]
+        for r in results:
+            if isinstance(r, Exception):
+                raise r
+        return results
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.connections = []
+
+
+def _stallone_parameters(A, p0, outputs):
+    """
+    Stallone HMM parameters from the transition matrix A, the initial
+    distribution p0 and the output parameters of every state (rows of
+    outputs: output probabilities, or mean and variance).
+    """
+    par = _st.API.hmmNew.parameters(len(A), False, False)
+    par.setTransitionMatrix(_st.ndarray_to_stallone_array(A))
+    par.setInitialDistribution(_st.ndarray_to_stallone_array(p0))
+    for i, row in enumerate(outputs):
+        par.setOutputParameters(i, _st.ndarray_to_stallone_array(row))
+    return par
+
+
+class HMM(object):
+    """
+    Hidden Markov model estimated by Baum-Welch.
+
+    Parameters
+    ----------
+    nstates : int
+      number of hidden states.
+    max_iter : int
+      maximum number of Baum-Welch iterations.
+    tol : float
+      fit stops, when the log likelihood increases by less than tol.
+    seed : (optional) int
+      seed for the initial parameters.
+    n_jobs : int
+      engine='stallone': number of JVM threads for the Viterbi paths.
+      engine='numpy': number of worker processes, at most the number of
+      cpus. 1 computes everything in the calling process, which is also done
+      on Python 2.
+    engine : 'stallone' or 'numpy'
+      run Baum-Welch and Viterbi in Stallone (needs a started JVM) or in
+      python.
+
+    Attributes
+    ----------
+    transition_matrix : ndarray of shape (nstates, nstates)
+
+    initial_distribution : ndarray of shape (nstates,)
+
+    output_probabilities : ndarray of shape (nstates, nsymbols)
+      for discrete observations.
+    means, variances : ndarrays of shape (nstates,)
+      for gaussian observations.
+    likelihood : float
+      log likelihood of the observations.
+    iterations : int
+      number of Baum-Welch iterations performed.
+    """
+    def __init__(self, nstates, max_iter=100, tol=1e-4, seed=None, n_jobs=1,
+                 engine='stallone'):
+        if nstates < 1:
+            raise ValueError('nstates has to be positive, given was %s'
+                             % nstates)
+        if engine not in ('stallone', 'numpy'):
+            raise ValueError('unknown engine "%s"' % engine)
+        self.engine = engine
+        self.nstates = nstates
+        self.max_iter = max_iter
+        self.tol = tol
+        self.n_jobs = n_jobs
+        self._random = _np.random.RandomState(seed)
+        self.observations = None
+
+    def _init_parameters(self, obs):
+        N = self.nstates
+        self.initial_distribution = _np.repeat(1.0 / N, N)
+        # metastable guess
+        A = _np.full((N, N), 0.1 / N)
+        A[_np.diag_indices(N)] += 0.9
+        self.transition_matrix = A
+        if obs.discrete:
+            nsymbols = int(obs.data.max()) + 1
+            B = self._random.dirichlet(_np.ones(nsymbols), size=N)
+            # avoid zeros of symbols that are observed
+            B += 1e-3 * (_np.bincount(obs.data, minlength=nsymbols) > 0)
+            self.output_probabilities = B / B.sum(axis=1)[:, None]
+        else:
+            self.means = _np.percentile(obs.data,
+                                        100 * (_np.arange(N) + 0.5) / N)
+            self.variances = _np.repeat(max(obs.data.var(), 1e-12), N)
+
+    def _parameters(self):
+        if self.observations.discrete:
+            emission = self.output_probabilities
+        else:
+            emission = _np.vstack((self.means, self.variances))
+        return (self.transition_matrix, self.initial_distribution,
+                self.observations.discrete, emission)
+
+    def _split(self, obs):
+        """
+        indices of the non-empty trajectories of obs in groups, one per
+        worker process, and the packed groups.
+        """
+        nonempty = _np.flatnonzero(_np.diff(obs.offsets))
+        n_jobs = 1
+        if hasattr(_mp, 'get_context'):
+            n_jobs = min(self.n_jobs, _mp.cpu_count())
+        lengths = _np.diff(obs.offsets)[nonempty]
+        index = [nonempty[g] for g in _groups(lengths, max(1, n_jobs))]
+        return index, [_Packed([obs[i] for i in g]) for g in index]
+
+    def fit(self, trajs):
+        """
+        Estimates the model.
+
+        Parameters
+        ----------
+        trajs : ndarray, list of ndarrays or Observations
+          observation trajectories, all int (discrete) or float (gaussian).
+        """
+        obs = trajs if isinstance(trajs, Observations) else Observations(trajs)
+        if not len(obs.data):
+            raise ValueError('observations contain no frames')
+        self.observations = obs
+        self._init_parameters(obs)
+        if self.engine == 'stallone':
+            return self._fit_stallone(obs)
+        self.likelihood = -_np.inf
+        self.iterations = 0
+        _, groups = self._split(obs)
+        workers = _Workers(groups)
+        try:
+            for it in range(self.max_iter):
+                results = workers.map(_estep, self._parameters())
+                logl = sum(r[0] for r in results)
+
+                p0 = sum(r[1] for r in results)
+                self.initial_distribution = p0 / p0.sum()
+                xi = sum(r[2] for r in results)
+                # states without transitions out stay
+                xi[xi.sum(axis=1) == 0] += _np.eye(self.nstates)[
+                    xi.sum(axis=1) == 0]
+                self.transition_matrix = xi / xi.sum(axis=1)[:, None]
+                stats = sum(r[3] for r in results)
+                if obs.discrete:
+                    self.output_probabilities = stats / _np.maximum(
+                        stats.sum(axis=1), 1e-300)[:, None]
+                else:
+                    w = _np.maximum(stats[0], 1e-300)
+                    self.means = stats[1] / w
+                    self.variances = _np.maximum(stats[2] / w - self.means**2,
+                                                 1e-12)
+
+                self.iterations = it + 1
+                converged = logl - self.likelihood < self.tol
+                self.likelihood = logl
+                if converged:
+                    break
+        finally:
+            workers.close()
+        return self
+
+    def _output_rows(self):
+        """ output parameters of every state as rows """
+        if self.observations.discrete:
+            return self.output_probabilities
+        return _np.column_stack((self.means, self.variances))
+
+    def _fit_stallone(self, obs):
+        """ Baum-Welch in Stallone, started from the initial parameters """
+        par = _stallone_parameters(self.transition_matrix,
+                                   self.initial_distribution,
+                                   self._output_rows())
+        if obs.discrete:
+            em = _st.API.hmmNew.emDiscrete(obs.stallone, par)
+        else:
+            em = _st.API.hmmNew.emGaussian(obs.stallone, par)
+        em.setMaximumNumberOfStep(self.max_iter)
+        em.setLikelihoodDecreaseTolerance(self.tol)
+        em.run()
+
+        par = em.getParameters()
+        self.transition_matrix = _st.stallone_array_to_ndarray(
+            par.getTransitionMatrix())
+        self.initial_distribution = _st.stallone_array_to_ndarray(
+            par.getInitialDistribution())
+        outputs = _np.vstack([_st.stallone_array_to_ndarray(
+            par.getOutputParameters(i)) for i in range(self.nstates)])
+        if obs.discrete:
+            self.output_probabilities = outputs
+        else:
+            self.means, self.variances = outputs[:, 0], outputs[:, 1]
+        history = _st.stallone_array_to_ndarray(em.getLogLikelihoodHistory())
+        self.iterations = len(history)
+        self.likelihood = history[-1] if len(history) else -_np.inf
+        return self
+
+    def _viterbi_stallone(self, obs):
+        """
+        Viterbi paths by Stallone on JVM threads, copied back into one
+        buffer.
+        """
+        par = _stallone_parameters(self.transition_matrix,
+                                   self.initial_distribution,
+                                   self._output_rows())
+        if obs.discrete:
+            viterbi = _st.API.hmm.viterbiDiscrete
+        else:
+            viterbi = _st.API.hmm.viterbiGaussian
+        nonempty = _np.flatnonzero(_np.diff(obs.offsets))
+        data = obs.stallone
+        out = _np.zeros(len(obs.data), dtype=_np.int32)
+
+        def path(k):
+            i = nonempty[k]
+            _st._copy_into(viterbi(par, data.get(k)),
+                           out[obs.offsets[i]:obs.offsets[i + 1]])
+
+        _st._jvm_map(path, range(len(nonempty)), self.n_jobs)
+        return [out[a:b] for a, b in zip(obs.offsets[:-1], obs.offsets[1:])]
+
+    def viterbi(self, trajs=None):
+        """
+        Most likely hidden paths.
+
+        Parameters
+        ----------
+        trajs : (optional) ndarray, list of ndarrays or Observations
+          defaults to the observations the model was fitted with.
+
+        Returns
+        -------
+        list of int32 ndarrays
+        """
+        if trajs is None:
+            if self.observations is None:
+                raise RuntimeError('model has not been fitted yet')
+            obs = self.observations
+        elif isinstance(trajs, Observations):
+            obs = trajs
+        else:
+            obs = Observations(trajs)
+
+        if self.engine == 'stallone':
+            return self._viterbi_stallone(obs)
+        index, groups = self._split(obs)
+        workers = _Workers(groups)
+        try:
+            results = workers.map(_viterbi, self._parameters())
+        finally:
+            workers.close()
+        paths = [_np.empty(0, dtype=_np.int32) for _ in range(len(obs))]
+        for ind, group in zip(index, results):
+            for i, path in zip(ind, group):
+                paths[i] = path
+        return paths
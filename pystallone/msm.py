@@ -0,0 +1,916 @@
+'''
+Markov model estimation and analysis on numpy data.
+
+Functions in this module accept ndarrays (and scipy.sparse matrices), do the
+marshaling to Stallone in bulk and return ndarrays.
+
+Note:
+-----
+Functions returning sparse matrices require scipy.
+'''
+
+import multiprocessing as _mp
+import threading as _threading
+from multiprocessing.pool import ThreadPool as _ThreadPool
+
+import numpy as _np
+import pystallone as _st
+
+__all__ = ['count_matrix', 'largest_connected_set', 'transition_matrix',
+           'implied_timescales', 'stationary_distributions', 'eigenvalues',
+           'sample_transition_matrices', 'bootstrap', 'committors', 'mfpts',
+           'propagate', 'cktest', 'PCCA', 'pcca']
+
+""" number of frames processed at once, bounds temporary memory """
+_chunksize = 2**24
+
+
+def _as_dtraj_list(dtrajs):
+    if isinstance(dtrajs, _np.ndarray):
+        dtrajs = [dtrajs]
+    return [_np.asarray(d) for d in dtrajs]
+
+
+def _transition_codes(dtraj, lag, nstates):
+    """
+    yields the transitions of dtraj at given lag as flat indices
+    (from * nstates + to), chunk by chunk.
+    """
+    n = len(dtraj)
+    for start in range(0, max(n - lag, 0), _chunksize):
+        stop = min(start + _chunksize, n - lag)
+        frm = dtraj[start:stop].astype(_np.int64)
+        to = dtraj[start + lag:stop + lag].astype(_np.int64)
+        # negative states mark frames which are not assigned
+        valid = (frm >= 0) & (to >= 0)
+        if not valid.all():
+            frm = frm[valid]
+            to = to[valid]
+        frm *= nstates
+        frm += to
+        yield frm
+
+
+def count_matrix(dtrajs, lag=1, sliding=True, nstates=None):
+    """
+    Counts the transitions at given lag time in discrete trajectories.
+
+    The counting is vectorized and done in chunks, so it scales to long
+    trajectories and many states without marshaling the trajectories to java.
+
+    Parameters
+    ----------
+    dtrajs : ndarray or list of ndarrays of int
+      discrete trajectories. Negative entries are treated as unassigned frames
+      and transitions from or into them are not counted.
+    lag : int
+      lag time in frames.
+    sliding : boolean
+      if true, count with a sliding window (every frame starts a transition),
+      otherwise only every lag-th frame is used (strided counting).
+    nstates : (optional) int
+      number of states. Defaults to the largest state found plus one.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of float64 with shape (nstates, nstates)
+    """
+    from scipy.sparse import coo_matrix
+
+    if lag < 1:
+        raise ValueError('lag has to be positive, given was %s' % lag)
+    dtrajs = _as_dtraj_list(dtrajs)
+    for d in dtrajs:
+        if d.ndim != 1 or d.dtype.kind not in 'iu':
+            raise TypeError('discrete trajectories have to be 1-d int arrays')
+    largest = max([int(d.max()) for d in dtrajs if len(d)] + [-1])
+    if nstates is None:
+        nstates = largest + 1
+    elif largest >= nstates:
+        raise ValueError('discrete trajectories contain state %i, but nstates'
+                         ' is %i' % (largest, nstates))
+
+    codes = []
+    counts = []
+    for d in dtrajs:
+        if not sliding:
+            d, step_lag = d[::lag], 1
+        else:
+            step_lag = lag
+        for c in _transition_codes(d, step_lag, nstates):
+            c, n = _np.unique(c, return_counts=True)
+            codes.append(c)
+            counts.append(n)
+
+    if codes:
+        codes, inverse = _np.unique(_np.concatenate(codes),
+                                    return_inverse=True)
+        counts = _np.bincount(inverse.ravel(),
+                              weights=_np.concatenate(counts))
+    else:
+        codes = _np.empty(0, dtype=_np.int64)
+        counts = _np.empty(0, dtype=_np.float64)
+
+    rows, cols = _np.divmod(codes, nstates)
+    return coo_matrix((counts, (rows, cols)),
+                      shape=(nstates, nstates)).tocsr()
+
+
+def largest_connected_set(C):
+    """
+    Returns the states of the largest strongly connected set of the count
+    matrix C (dense or scipy.sparse) as sorted ndarray.
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    ncomp, labels = connected_components(csr_matrix(C), directed=True,
+                                         connection='strong')
+    largest = _np.argmax(_np.bincount(labels))
+    return _np.flatnonzero(labels == largest)
+
+
+def _estimate_T(C, reversible=True, T0=None):
+    """
+    estimates a transition matrix in Stallone from the count matrix C.
+
+    Returns
+    -------
+    IDoubleArray
+    """
+    if hasattr(C, 'toarray'):
+        C = C.toarray()
+    # the direct buffers reference C and T0, keep them bound until returned
+    C = _np.ascontiguousarray(C, _np.float64)
+    Cs = _st.ndarray_to_stallone_array(C, copy=False)
+    if not reversible:
+        return _st.API.msm.estimateT(Cs)
+    if T0 is None:
+        return _st.API.msm.estimateTrev(Cs)
+    T0 = _np.ascontiguousarray(T0, _np.float64)
+    if T0.shape != C.shape:
+        raise ValueError('T0 has shape %s, should be %s'
+                         % (T0.shape, C.shape))
+    T0s = _st.ndarray_to_stallone_array(T0, copy=False)
+    return _st.API.msm.estimateTrev(Cs, T0s)
+
+
+def transition_matrix(C, reversible=True, T0=None, out=None):
+    """
+    Estimates the maximum likelihood transition matrix from counts.
+
+    Counts and initial guess are passed to Stallone as direct buffers and the
+    result is copied on the java side into out, so no python objects are
+    created for the matrix elements.
+
+    Parameters
+    ----------
+    C : ndarray or scipy.sparse matrix of shape (n, n)
+      count matrix, should be connected. Sparse matrices are densified into
+      one float64 buffer.
+    reversible : boolean
+      if true, estimate a reversible transition matrix with Stallone's
+      iterative solver.
+    T0 : (optional) ndarray of shape (n, n)
+      initial guess for the reversible solver, e.g. the estimate of the
+      previous iteration of an outer loop (warm start).
+    out : (optional) ndarray
+      c-contiguous float64 array of shape (n, n) to write the result into.
+      It may be the same array as T0.
+
+    Returns
+    -------
+    ndarray of shape (n, n) : out, if given.
+    """
+    if C.ndim != 2 or C.shape[0] != C.shape[1]:
+        raise ValueError('count matrix has to be square, shape is %s'
+                         % (C.shape,))
+    T = _estimate_T(C, reversible, T0)
+    return _st.stallone_array_to_ndarray(T, out=out)
+
+
+def _timescales(T, lag, k):
+    """ returns the k largest implied timescales of T, padded with nan """
+    ts = _st.stallone_array_to_ndarray(_st.API.msm.timescales(T, lag))
+    # the stationary process has an infinite timescale
+    ts = _np.sort(ts[_np.isfinite(ts)])[::-1][:k]
+    return _np.append(ts, _np.repeat(_np.nan, k - len(ts)))
+
+
+def implied_timescales(dtrajs, lags, k=10, reversible=True, sliding=True,
+                       n_jobs=None):
+    """
+    Computes implied timescales for several lag times at once.
+
+    For every lag the count matrix is restricted to its largest connected set,
+    a (reversible) transition matrix is estimated by Stallone and its implied
+    timescales are computed. The lags are processed concurrently on JVM
+    threads, the trajectories are shared among them.
+
+    Parameters
+    ----------
+    dtrajs : ndarray or list of ndarrays of int
+      discrete trajectories.
+    lags : sequence of int
+      lag times in frames.
+    k : int
+      number of timescales to compute per lag.
+    reversible : boolean
+      if true, estimate reversible transition matrices.
+    sliding : boolean
+      see count_matrix.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+
+    Returns
+    -------
+    ndarray of shape (len(lags), k). Missing timescales (small connected
+    sets) are nan.
+    """
+    dtrajs = _as_dtraj_list(dtrajs)
+    nstates = max([int(d.max()) for d in dtrajs if len(d)] + [-1]) + 1
+
+    def its(lag):
+        C = count_matrix(dtrajs, lag, sliding=sliding, nstates=nstates)
+        lcc = largest_connected_set(C)
+        C = C[lcc, :][:, lcc].toarray()
+        return _timescales(_estimate_T(C, reversible), lag, k)
+
+    return _np.vstack(_st._jvm_map(its, list(lags), n_jobs))
+
+
+def _as_matrix_stack(Ts):
+    Ts = _np.ascontiguousarray(Ts, dtype=_np.float64)
+    if Ts.ndim == 2:
+        Ts = Ts[None]
+    if Ts.ndim != 3 or Ts.shape[1] != Ts.shape[2]:
+        raise ValueError('expected a stack of square matrices with shape '
+                         '(n_samples, n, n), got %s' % (Ts.shape,))
+    return Ts
+
+
+def stationary_distributions(Ts, out=None, n_jobs=None):
+    """
+    Computes the stationary distributions of many transition matrices.
+
+    The matrices are passed to Stallone as direct buffers on the stack and
+    processed concurrently on JVM threads. Every result is copied on the java
+    side into its row of the output.
+
+    Parameters
+    ----------
+    Ts : ndarray of shape (n_samples, n, n)
+      stack of transition matrices, e.g. bootstrap or Bayesian samples.
+    out : (optional) ndarray of shape (n_samples, n)
+      c-contiguous float64 array to write the results to.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+
+    Returns
+    -------
+    ndarray of shape (n_samples, n) : out, if given.
+    """
+    Ts = _as_matrix_stack(Ts)
+    shape = Ts.shape[:2]
+    if out is None:
+        out = _np.empty(shape)
+    elif out.shape != shape:
+        raise ValueError('out has wrong shape %s, should be %s'
+                         % (out.shape, shape))
+
+    def stationary(i):
+        T = _st.ndarray_to_stallone_array(Ts[i], copy=False)
+        _st.stallone_array_to_ndarray(_st.API.msm.stationaryDistribution(T),
+                                      out=out[i])
+
+    _st._jvm_map(stationary, range(len(Ts)), n_jobs)
+    return out
+
+
+def eigenvalues(Ts, k=None, n_jobs=None):
+    """
+    Computes the leading eigenvalues of many transition matrices with
+    Stallone's eigenvalue decomposition, concurrently on JVM threads.
+
+    Parameters
+    ----------
+    Ts : ndarray of shape (n_samples, n, n)
+      stack of transition matrices.
+    k : (optional) int
+      number of eigenvalues per matrix, all if not given.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+
+    Returns
+    -------
+    complex128 ndarray of shape (n_samples, k), sorted by decreasing modulus.
+    """
+    Ts = _as_matrix_stack(Ts)
+    n = Ts.shape[1]
+    k = n if k is None else min(k, n)
+
+    def evals(i):
+        T = _st.ndarray_to_stallone_array(Ts[i], copy=False)
+        ev = _st.stallone_array_to_ndarray(_st.API.alg.evd(T).getEval())
+        return ev[_np.argsort(-_np.abs(ev), kind='mergesort')][:k]
+
+    return _np.vstack(_st._jvm_map(evals, range(len(Ts)), n_jobs))
+
+
+def _chain_seeds(seed, n_chains):
+    """ reproducible, distinct seeds for n_chains random streams """
+    return _np.random.RandomState(seed).randint(2**31 - 1, size=n_chains)
+
+
+def sample_transition_matrices(C, n_samples, n_chains=4, reversible=True,
+                               burn_in=1000, thin=100, reduce=None, out=None,
+                               seed=None):
+    """
+    Samples transition matrices from their posterior given counts C with
+    several independent chains.
+
+    Reversible matrices are sampled with Stallone's MCMC sampler, every chain
+    runs concurrently on its own JVM thread. Burn-in and thinning are done on the java
+    side, only every thin-th sample is transferred. Non-reversible matrices
+    are drawn exactly from the row-wise Dirichlet posterior, so burn_in and
+    thin are not needed.
+
+    Parameters
+    ----------
+    C : ndarray or scipy.sparse matrix of shape (n, n)
+      connected count matrix.
+    n_samples : int
+      total number of samples, divided among the chains.
+    n_chains : int
+      number of independent chains.
+    reversible : boolean
+      sample reversible transition matrices.
+    burn_in : int
+      number of MCMC steps discarded at the start of every chain.
+    thin : int
+      number of MCMC steps between two returned samples.
+    reduce : (optional) callable
+      maps a sampled transition matrix (ndarray) to the statistic to store,
+      e.g. its timescales. The matrices themselves are stored if not given.
+    out : (optional) ndarray
+      ring buffer of shape (capacity,) + statistic shape. Every chain owns
+      a contiguous slice of the buffer: its share of the samples if capacity
+      >= n_samples, otherwise capacity / n_chains slots, which it fills as a
+      ring. A smaller buffer thus keeps the latest samples of every chain.
+    seed : (optional) int
+      seed from which the seeds of all chains are derived. Reproducibility
+      of reversible chains is subject to the random number generator of the
+      Stallone sampler.
+
+    Returns
+    -------
+    ndarray : out, or a new array of n_samples entries.
+    """
+    if hasattr(C, 'toarray'):
+        C = C.toarray()
+    C = _np.ascontiguousarray(C, dtype=_np.float64)
+    n_chains = max(1, min(n_chains, n_samples))
+    per_chain = [n_samples // n_chains + (c < n_samples % n_chains)
+                 for c in range(n_chains)]
+    seeds = _chain_seeds(seed, n_chains)
+
+    # chain c owns the slots offsets[c] to offsets[c] + slots[c] and stores
+    # sample s at offsets[c] + s % slots[c]
+    capacity = n_samples if out is None else len(out)
+    if capacity >= n_samples:
+        slots = per_chain
+    elif capacity >= n_chains:
+        slots = [capacity // n_chains + (c < capacity % n_chains)
+                 for c in range(n_chains)]
+    else:
+        raise ValueError('out has %i entries, at least one per chain (%i) is '
+                         'needed' % (capacity, n_chains))
+    offsets = _np.cumsum([0] + slots[:-1])
+    lock = _threading.Lock()
+    state = {'buffer': out}
+    if out is None and reduce is None:
+        state['buffer'] = _np.empty((n_samples,) + C.shape)
+
+    def store(c, s, T):
+        """ stores the IDoubleArray or ndarray sample s of chain c """
+        if reduce is not None:
+            if not isinstance(T, _np.ndarray):
+                T = _st.stallone_array_to_ndarray(T)
+            T = reduce(T)
+        with lock:
+            if state['buffer'] is None:
+                state['buffer'] = _np.empty((n_samples,) + _np.shape(T))
+            buf = state['buffer']
+        i = offsets[c] + s % slots[c]
+        if isinstance(T, _np.ndarray) or reduce is not None:
+            buf[i] = T
+        else:
+            _st.stallone_array_to_ndarray(T, out=buf[i])
+
+    if reversible:
+        Cs = _st.ndarray_to_stallone_array(C, copy=False)
+
+        def chain(c):
+            sampler = _st.API.msmNew.createTransitionMatrixSamplerRev(Cs)
+            if burn_in > 0:
+                sampler.sample(burn_in)
+            for s in range(per_chain[c]):
+                store(c, s, sampler.sample(thin))
+
+        _st._jvm_map(chain, range(n_chains), n_chains)
+    else:
+        # exact sampling is cheap, the chains are run one after another
+        nonzero = C > 0
+        for c in range(n_chains):
+            random = _np.random.RandomState(seeds[c])
+            for s in range(per_chain[c]):
+                G = _np.zeros_like(C)
+                G[nonzero] = random.standard_gamma(C[nonzero])
+                store(c, s, G / G.sum(axis=1)[:, None])
+
+    return state['buffer']
+
+
+def bootstrap(dtrajs, lag, n_samples, observable=None, k=5, reversible=True,
+              sliding=True, seed=None, n_jobs=None):
+    """
+    Bootstraps an observable of the Markov model by resampling trajectories.
+
+    The transitions of every trajectory are counted only once. A resample is
+    an index array of trajectories, its (sparse) count matrix is the weighted
+    sum of their counts. Transition matrices of the resamples are estimated by
+    Stallone concurrently on JVM threads.
+
+    Parameters
+    ----------
+    dtrajs : list of ndarrays of int
+      discrete trajectories.
+    lag : int
+      lag time in frames.
+    n_samples : int
+      number of bootstrap samples.
+    observable : (optional) callable
+      maps the transition matrix (ndarray, restricted to the largest
+      connected set of the resample) to an ndarray or scalar of fixed shape.
+      Defaults to the k largest implied timescales.
+    k : int
+      number of timescales for the default observable.
+    reversible : boolean
+      estimate reversible transition matrices.
+    sliding : boolean
+      see count_matrix.
+    seed : (optional) int
+      seed for the resampling.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+
+    Returns
+    -------
+    ndarray of shape (n_samples,) + observable shape
+    """
+    from scipy.sparse import coo_matrix, csr_matrix
+
+    dtrajs = _as_dtraj_list(dtrajs)
+    n_trajs = len(dtrajs)
+    nstates = max([int(d.max()) for d in dtrajs if len(d)] + [-1]) + 1
+
+    # flattened count matrices of all trajectories as rows of one matrix
+    rows, cols, vals = [], [], []
+    for i, d in enumerate(dtrajs):
+        C = count_matrix(d, lag, sliding=sliding, nstates=nstates).tocoo()
+        rows.append(_np.repeat(i, C.nnz))
+        cols.append(C.row.astype(_np.int64) * nstates + C.col)
+        vals.append(C.data)
+    counts = coo_matrix((_np.concatenate(vals),
+                         (_np.concatenate(rows), _np.concatenate(cols))),
+                        shape=(n_trajs, nstates * nstates)).tocsr()
+
+    resamples = _np.random.RandomState(seed).randint(n_trajs,
+                                                     size=(n_samples, n_trajs))
+
+    def estimate(i):
+        weights = csr_matrix(_np.bincount(resamples[i], minlength=n_trajs))
+        flat = weights.dot(counts).tocoo()
+        C = coo_matrix((flat.data, _np.divmod(flat.col, nstates)),
+                       shape=(nstates, nstates)).tocsr()
+        # only the block passed to Stallone is dense
+        lcc = largest_connected_set(C)
+        T = _estimate_T(C[lcc][:, lcc].toarray(), reversible)
+        if observable is None:
+            return _timescales(T, lag, k)
+        return observable(_st.stallone_array_to_ndarray(T))
+
+    return _np.array(_st._jvm_map(estimate, range(n_samples), n_jobs))
+
+
+def _as_state_set(A, n):
+    A = _np.unique(_np.asarray(A, dtype=_np.int32))
+    if len(A) == 0 or A[0] < 0 or A[-1] >= n:
+        raise ValueError('state sets have to be non-empty and contain states '
+                         'between 0 and %i' % (n - 1))
+    return A
+
+
+def committors(T, pairs, backward=False, n_jobs=None):
+    """
+    Computes committors of many source/target set pairs on the same
+    transition matrix with Stallone's transition path theory.
+
+    T is passed to Stallone once (as direct buffer) and shared by all pairs,
+    which are solved concurrently on JVM threads.
+
+    Parameters
+    ----------
+    T : ndarray of shape (n, n)
+      transition matrix.
+    pairs : sequence of (A, B)
+      source and target sets as int arrays of possibly different lengths.
+    backward : boolean
+      also return the backward committors.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+
+    Returns
+    -------
+    ndarray of shape (len(pairs), n) of forward committors, and the backward
+    committors of the same shape if backward is true.
+    """
+    T = _np.ascontiguousarray(T, dtype=_np.float64)
+    n = T.shape[0]
+    pairs = [(_as_state_set(A, n), _as_state_set(B, n)) for A, B in pairs]
+    Ts = _st.ndarray_to_stallone_array(T, copy=False)
+    forward = _np.empty((len(pairs), n))
+    backward_out = _np.empty((len(pairs), n)) if backward else None
+
+    def solve(i):
+        A, B = pairs[i]
+        tpt = _st.API.msmNew.createTPT(Ts,
+                                       _st.ndarray_to_stallone_array(A),
+                                       _st.ndarray_to_stallone_array(B))
+        _st.stallone_array_to_ndarray(tpt.getForwardCommittor(),
+                                      out=forward[i])
+        if backward:
+            _st.stallone_array_to_ndarray(tpt.getBackwardCommittor(),
+                                          out=backward_out[i])
+
+    _st._jvm_map(solve, range(len(pairs)), n_jobs)
+    if backward:
+        return forward, backward_out
+    return forward
+
+
+def mfpts(T, targets, lag=1, n_jobs=None):
+    """
+    Computes the mean first passage times from every state into each of many
+    target sets.
+
+    For every target set B the linear system (I - T) m = lag is solved on the
+    states outside of B. The systems are solved concurrently by a pool of
+    threads (LAPACK releases the GIL).
+
+    Parameters
+    ----------
+    T : ndarray of shape (n, n)
+      transition matrix.
+    targets : sequence of int arrays
+      target sets of possibly different lengths.
+    lag : float
+      lag time of T, the unit of the result.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+
+    Returns
+    -------
+    ndarray of shape (len(targets), n), zero on the target states.
+    """
+    T = _np.asarray(T, dtype=_np.float64)
+    n = T.shape[0]
+    targets = [_as_state_set(B, n) for B in targets]
+    out = _np.zeros((len(targets), n))
+
+    def solve(i):
+        rest = _np.setdiff1d(_np.arange(n), targets[i])
+        if not len(rest):
+            return
+        A = _np.eye(len(rest)) - T[_np.ix_(rest, rest)]
+        out[i, rest] = _np.linalg.solve(A, _np.repeat(float(lag), len(rest)))
+
+    pool = _ThreadPool(n_jobs)
+    try:
+        pool.map(solve, range(len(targets)))
+    finally:
+        pool.terminate()
+    return out
+
+
+def propagate(T, p0, steps, out=None):
+    """
+    Propagates initial distributions by the transition matrix, p0 T^k, for
+    several step counts k at once.
+
+    The recurrence is run as block matrix products of all initial
+    distributions, advancing from one requested step count to the next.
+    Sparse transition matrices are kept sparse.
+
+    Parameters
+    ----------
+    T : ndarray or scipy.sparse matrix of shape (n, n)
+      transition matrix.
+    p0 : ndarray of shape (m, n) or (n,)
+      initial distributions.
+    steps : sequence of int
+      non-negative step counts, in any order.
+    out : (optional) ndarray of shape (m, len(steps), n)
+      float64 array to write the results to.
+
+    Returns
+    -------
+    ndarray of shape (m, len(steps), n) : out, if given. For a 1-d p0 the
+    shape is (len(steps), n).
+    """
+    p0 = _np.asarray(p0, dtype=_np.float64)
+    squeeze = p0.ndim == 1
+    P = _np.atleast_2d(p0)
+    steps = _np.asarray(steps, dtype=_np.int64)
+    if steps.ndim != 1 or (steps < 0).any():
+        raise ValueError('steps have to be a sequence of non-negative ints')
+    shape = (P.shape[0], len(steps), P.shape[1])
+    if out is None:
+        out = _np.empty(shape)
+    elif out.shape != shape:
+        raise ValueError('out has wrong shape %s, should be %s'
+                         % (out.shape, shape))
+
+    # p T = (T^t p^t)^t, which keeps the product sparse aware
+    Tt = T.T
+    current = 0
+    for i in _np.argsort(steps, kind='mergesort'):
+        for _ in range(steps[i] - current):
+            P = _np.asarray(Tt.dot(P.T)).T
+        current = steps[i]
+        out[:, i, :] = P
+
+    return out[0] if squeeze else out
+
+
+def _set_probabilities(sets, nstates, lcc, T, pi, k):
+    """
+    probabilities to be in set B after k steps of T, when starting in set A
+    from the local equilibrium distribution. Returns (n_sets, n_sets).
+    """
+    pos = _np.repeat(-1, nstates)
+    pos[lcc] = _np.arange(len(lcc))
+    P0 = _np.zeros((len(sets), len(lcc)))
+    membership = _np.zeros((len(sets), len(lcc)))
+    for i, A in enumerate(sets):
+        ind = pos[A]
+        ind = ind[ind >= 0]
+        membership[i, ind] = 1
+        P0[i, ind] = pi[ind] / pi[ind].sum() if len(ind) else _np.nan
+    Pk = propagate(T, P0, [k])[:, 0, :]
+    return _np.dot(Pk, membership.T)
+
+
+def cktest(dtrajs, sets, lag, multiples, reversible=True, sliding=True,
+           n_jobs=None):
+    """
+    Chapman-Kolmogorov test of a Markov model with lag time lag.
+
+    For every set A of the partition and multiple k, the probability to be
+    in set B after k * lag frames, starting from the local equilibrium in A,
+    is predicted by the model at lag and estimated by models at k * lag.
+    All models are estimated concurrently on JVM threads from the same
+    trajectories.
+
+    Parameters
+    ----------
+    dtrajs : ndarray or list of ndarrays of int
+      discrete trajectories.
+    sets : sequence of int arrays
+      disjoint sets of states, e.g. metastable sets.
+    lag : int
+      lag time of the tested model.
+    multiples : sequence of int
+      multiples k of lag to test.
+    reversible : boolean
+      estimate reversible transition matrices.
+    sliding : boolean
+      see count_matrix.
+    n_jobs : (optional) int
+      number of threads, defaults to the number of cpus.
+
+    Returns
+    -------
+    (predicted, estimated) : ndarrays of shape (len(multiples), n_sets, n_sets)
+    """
+    dtrajs = _as_dtraj_list(dtrajs)
+    nstates = max([int(d.max()) for d in dtrajs if len(d)] + [-1]) + 1
+    sets = [_np.asarray(A, dtype=_np.int64) for A in sets]
+    multiples = [int(k) for k in multiples]
+    if min(multiples) < 1:
+        raise ValueError('multiples have to be positive')
+    lags = sorted(set([lag] + [k * lag for k in multiples]))
+
+    def model(tau):
+        C = count_matrix(dtrajs, tau, sliding=sliding, nstates=nstates)
+        lcc = largest_connected_set(C)
+        T = transition_matrix(C[lcc, :][:, lcc].toarray(), reversible)
+        pi = stationary_distributions(T, n_jobs=1)[0]
+        return lcc, T, pi
+
+    models = dict(zip(lags, _st._jvm_map(model, lags, n_jobs)))
+
+    shape = (len(multiples), len(sets), len(sets))
+    predicted = _np.empty(shape)
+    estimated = _np.empty(shape)
+    for i, k in enumerate(multiples):
+        predicted[i] = _set_probabilities(sets, nstates, *models[lag], k=k)
+        estimated[i] = _set_probabilities(sets, nstates, *models[k * lag],
+                                          k=1)
+    return predicted, estimated
+
+
+def _fill_matrix(rot_crop, X):
+    """
+    completes the lower right (m-1, m-1) block of a PCCA+ rotation matrix to
+    a feasible one: memberships X rot are non-negative and sum to one.
+    """
+    rot = _np.hstack((-rot_crop.sum(axis=1)[:, None], rot_crop))
+    first = (-_np.dot(X[:, 1:], rot)).max(axis=0)
+    rot = _np.vstack((first, rot))
+    return rot / first.sum()
+
+
+def _pcca(X, m):
+    """
+    PCCA+ memberships from the leading m eigenvectors X[:, :m], which are
+    orthonormal w.r.t. the stationary distribution with constant first one
+    (Roeblitz and Weber, Adv. Data Anal. Classif. 7, 147 (2013)).
+    """
+    from scipy.optimize import fmin
+    n = X.shape[0]
+    if m == 1:
+        return _np.ones((n, 1))
+    X = X[:, :m]
+
+    # inner simplex algorithm: the m most distinct states as vertices
+    ortho = X - X[_np.argmax((X**2).sum(axis=1))]
+    vertices = [_np.argmax((X**2).sum(axis=1))]
+    for _ in range(1, m):
+        v = ortho[vertices[-1]].copy()
+        ortho -= _np.outer(_np.dot(ortho, v), v)
+        dist = (ortho**2).sum(axis=1)
+        dist[vertices] = -1
+        vertices.append(_np.argmax(dist))
+        ortho /= _np.sqrt((ortho[vertices[-1]]**2).sum())
+    rot = _np.linalg.inv(X[vertices])
+
+    # maximize crispness of the memberships over feasible rotations
+    def objective(x):
+        rot = _fill_matrix(x.reshape(m - 1, m - 1), X)
+        return -(rot**2 / rot[0]).sum()
+
+    x = fmin(objective, rot[1:, 1:].ravel(), disp=False)
+    chi = _np.dot(X, _fill_matrix(x.reshape(m - 1, m - 1), X))
+    # remove round off
+    chi = _np.clip(chi, 0, 1)
+    chi /= chi.sum(axis=1)[:, None]
+    return chi
+
+
+# eigenvectors of the PCCA+ worker processes, sent once per pool
+_worker_eigenvectors = None
+
+
+def _set_worker_eigenvectors(X):
+    global _worker_eigenvectors
+    _worker_eigenvectors = X
+
+
+def _worker_pcca(m):
+    return _pcca(_worker_eigenvectors, m)
+
+
+class PCCA(object):
+    """
+    PCCA+ coarse-graining of a reversible transition matrix into metastable
+    sets.
+
+    The eigenvectors are computed once by Stallone and copied to python in a
+    single transfer, so memberships for any number of sets are evaluated
+    without passing the matrix to java again.
+
+    Parameters
+    ----------
+    T : ndarray, scipy.sparse matrix or IDoubleArray of shape (n, n)
+      reversible, connected transition matrix.
+
+    Attributes
+    ----------
+    eigenvalues : ndarray of shape (n,)
+      real parts of the eigenvalues, sorted by decreasing modulus.
+    eigenvectors : ndarray of shape (n, n)
+      right eigenvectors (columns) in the same order, normalized to
+      orthonormality w.r.t. the stationary distribution.
+    stationary_distribution : ndarray of shape (n,)
+    """
+    def __init__(self, T):
+        if hasattr(T, 'toarray'):
+            T = T.toarray()
+        # the direct buffer references _T_array, keep it with the wrapper
+        self._T_array = None
+        if not hasattr(T, 'getArray'):
+            self._T_array = _np.ascontiguousarray(T, dtype=_np.float64)
+            T = _st.ndarray_to_stallone_array(self._T_array, copy=False)
+        self.T = T
+        self._lock = _threading.Lock()
+        self._eigenvectors = None
+        self._memberships = {}
+
+    def _decompose(self):
+        """ decomposes T on the java side on first use """
+        with self._lock:
+            if self._eigenvectors is not None:
+                return
+            evd = _st.API.alg.evd(self.T)
+            ev = _st.stallone_array_to_ndarray(evd.getEval())
+            R = _st.stallone_array_to_ndarray(evd.getRightEigenvectorMatrix())
+            pi = _st.stallone_array_to_ndarray(
+                _st.API.msm.stationaryDistribution(self.T))
+            order = _np.argsort(-_np.abs(ev), kind='mergesort')
+            R = _np.real(R[:, order])
+            R /= _np.sqrt(_np.dot(pi, R**2))
+            # constant first eigenvector with positive sign
+            R[:, 0] *= _np.sign(R[:, 0].sum())
+            self.eigenvalues = _np.real(ev[order])
+            self.stationary_distribution = pi
+            self._eigenvectors = R
+
+    @property
+    def eigenvectors(self):
+        self._decompose()
+        return self._eigenvectors
+
+    def memberships(self, m, n_jobs=1):
+        """
+        PCCA+ memberships to m metastable sets. Results are cached, so
+        repeated calls for the same m are free.
+
+        Parameters
+        ----------
+        m : int or sequence of int
+          number(s) of metastable sets. Several numbers are evaluated in
+          parallel.
+        n_jobs : int
+          number of worker processes, at most the number of cpus. 1 computes
+          everything in the calling process, which is also done on Python 2.
+
+        Returns
+        -------
+        ndarray of shape (n, m), rows sum to one. A list of those, if m is a
+        sequence.
+        """
+        X = self.eigenvectors
+        n = X.shape[0]
+        single = isinstance(m, (int, _np.integer))
+        ms = [int(m)] if single else [int(k) for k in m]
+        for k in ms:
+            if not 1 <= k <= n:
+                raise ValueError('number of sets has to be in [1, %i], given '
+                                 'was %i' % (n, k))
+        todo = sorted(set(k for k in ms if k not in self._memberships))
+        if hasattr(_mp, 'get_context'):
+            n_jobs = min(n_jobs, _mp.cpu_count(), len(todo))
+        else:
+            n_jobs = 1
+        if n_jobs < 2:
+            chis = [_pcca(X, k) for k in todo]
+        else:
+            # the optimization holds the GIL, so it runs in processes. They
+            # are spawned, since the JVM of this process does not survive a
+            # fork, and receive the eigenvectors only once.
+            pool = _mp.get_context('spawn').Pool(
+                n_jobs, initializer=_set_worker_eigenvectors, initargs=(X,))
+            try:
+                chis = pool.map(_worker_pcca, todo)
+            finally:
+                pool.close()
+                pool.join()
+        self._memberships.update(zip(todo, chis))
+        chis = [self._memberships[k] for k in ms]
+        return chis[0] if single else chis
+
+    def metastable_assignment(self, m):
+        """ index of the metastable set with largest membership per state """
+        return _np.argmax(self.memberships(m), axis=1)
+
+
+def pcca(T, m, n_jobs=1):
+    """
+    PCCA+ memberships of the states of T to m metastable sets, see PCCA.
+
+    Returns
+    -------
+    ndarray of shape (n, m), or a list of those, if m is a sequence.
+    """
+    return PCCA(T).memberships(m, n_jobs)
@@ -0,0 +1,210 @@
+'''
+Process pool for embarrassingly parallel work with Stallone.
+
+JPype can start only one JVM per process and the JVM does not survive a
+fork. This pool therefore uses the 'spawn' (or 'forkserver') start method and
+starts the JVM exactly once in every worker, with the same jvm path and
+arguments given to pystallone.startJVM in the parent process.
+
+ndarrays passed as arguments are moved into shared memory once and only a
+small handle is pickled to the workers.
+
+Note:
+-----
+This module requires Python 3.8 or later (multiprocessing.shared_memory).
+
+Example
+-------
+>>> import pystallone
+>>> from pystallone.pool import Pool
+>>> pystallone.startJVM(None, ['-Xmx1g'])
+>>> with Pool(4) as pool:
+...     C = pool.map(count_matrix, dtrajs) # doctest: +SKIP
+'''
+
+import sys as _sys
+if _sys.version_info < (3, 8):
+    raise ImportError('pystallone.pool requires Python 3.8 or later')
+
+import multiprocessing as _mp
+from multiprocessing import shared_memory as _shared_memory
+
+import numpy as _np
+import pystallone as _st
+
+__all__ = ['Pool', 'SharedArray']
+
+
+class SharedArray(object):
+    """
+    ndarray living in shared memory, which can be passed to pool workers
+    without pickling its data.
+
+    Parameters
+    ----------
+    array : ndarray
+        data to copy into a new shared memory block.
+
+    Note:
+    -----
+    The process creating the SharedArray owns the memory block and has to
+    call release() (done by Pool for automatically shared arguments).
+    """
+    def __init__(self, array):
+        array = _np.asarray(array)
+        self._shm = _shared_memory.SharedMemory(create=True,
+                                                size=max(array.nbytes, 1))
+        self._owner = True
+        self.ndarray = _np.ndarray(array.shape, array.dtype,
+                                   buffer=self._shm.buf)
+        self.ndarray[...] = array
+
+    @classmethod
+    def _attach(cls, name, shape, dtype):
+        self = cls.__new__(cls)
+        self._shm = _shared_memory.SharedMemory(name=name)
+        self._owner = False
+        self.ndarray = _np.ndarray(shape, _np.dtype(dtype),
+                                   buffer=self._shm.buf)
+        return self
+
+    def __reduce__(self):
+        return (SharedArray._attach,
+                (self._shm.name, self.ndarray.shape, self.ndarray.dtype.str))
+
+    def release(self):
+        """ frees the shared memory block, if owned by this process. """
+        if self._shm is None:
+            return
+        self.ndarray = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+
+def _init_worker(jvm, args):
+    if not _st.isJVMStarted():
+        _st.startJVM(jvm, list(args) if args else None)
+
+
+def _resolve(obj):
+    return obj.ndarray if isinstance(obj, SharedArray) else obj
+
+
+def _run(func, args, kwds):
+    args = [_resolve(a) for a in args]
+    kwds = dict((k, _resolve(v)) for k, v in kwds.items())
+    return func(*args, **kwds)
+
+
+def _run_single(func_and_arg):
+    func, arg = func_and_arg
+    return func(_resolve(arg))
+
+
+class Pool(object):
+    """
+    Pool of worker processes, each running its own JVM with Stallone.
+
+    Parameters
+    ----------
+    processes : (optional) int
+        number of worker processes, defaults to the number of cpus.
+    context : (optional) string
+        multiprocessing start method, either 'spawn' or 'forkserver'.
+        'fork' is refused, since a JVM can not be forked.
+    jvm : (optional) string
+        path to the jvm for the workers. Defaults to the one given to
+        pystallone.startJVM in this process.
+    args : (optional) list
+        jvm parameters for the workers. Defaults to the ones given to
+        pystallone.startJVM in this process.
+
+    Note:
+    -----
+    Functions executed in the pool have to be picklable, e.g. defined at
+    module level.
+    """
+    def __init__(self, processes=None, context='spawn', jvm=None, args=None):
+        if context not in ('spawn', 'forkserver'):
+            raise ValueError('unsupported start method "%s". A JVM does not '
+                             'survive a fork, use "spawn" or "forkserver".'
+                             % context)
+        if jvm is None:
+            jvm = _st._jvm_path
+        if args is None:
+            args = _st._jvm_args
+        ctx = _mp.get_context(context)
+        self._pool = ctx.Pool(processes, initializer=_init_worker,
+                              initargs=(jvm, args))
+
+    def share(self, array):
+        """
+        copies the given ndarray into shared memory. The returned handle may
+        be passed to any number of tasks and has to be released by the caller.
+        """
+        return SharedArray(array)
+
+    @staticmethod
+    def _share(obj, shared):
+        if isinstance(obj, _np.ndarray):
+            obj = SharedArray(obj)
+            shared.append(obj)
+        return obj
+
+    def apply_async(self, func, args=(), kwds=None):
+        """
+        asynchronously evaluates func(*args, **kwds) in a worker. ndarray
+        arguments are passed via shared memory, which is released as soon as
+        the task has finished.
+
+        Returns
+        -------
+        multiprocessing.pool.AsyncResult
+        """
+        shared = []
+        args = tuple(self._share(a, shared) for a in args)
+        kwds = dict((k, self._share(v, shared))
+                    for k, v in (kwds or {}).items())
+
+        def release(_):
+            for s in shared:
+                s.release()
+
+        return self._pool.apply_async(_run, (func, args, kwds),
+                                      callback=release,
+                                      error_callback=release)
+
+    def apply(self, func, args=(), kwds=None):
+        """ evaluates func(*args, **kwds) in a worker and returns the result """
+        return self.apply_async(func, args, kwds).get()
+
+    def map(self, func, iterable, chunksize=None):
+        """
+        parallel equivalent of the builtin map(). ndarray items are passed
+        via shared memory.
+        """
+        shared = []
+        items = [(func, self._share(x, shared)) for x in iterable]
+        try:
+            return self._pool.map(_run_single, items, chunksize)
+        finally:
+            for s in shared:
+                s.release()
+
+    def close(self):
+        self._pool.close()
+
+    def join(self):
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.terminate()
+        return False
@@ -121,5 +121,120 @@ class TestPyStallone(unittest2.TestCase):
         for i in xrange(1, len(self.a)):
             self.assertEqual(self.a[i], stArr.get(i))
 
+    def testOut(self):
+        a = self.a.reshape((10, self.n // 10))
+        stArr = st.ndarray_to_stallone_array(a)
+        out = np.empty_like(a)
+        res = st.stallone_array_to_ndarray(stArr, out=out)
+        self.assertIs(out, res)
+        self.compareNP(a, out)
+
+    def testOutInvalid(self):
+        stArr = st.ndarray_to_stallone_array(self.a)
+        with self.assertRaises(ValueError):
+            st.stallone_array_to_ndarray(stArr, out=np.empty(self.n + 1))
+        with self.assertRaises(TypeError):
+            st.stallone_array_to_ndarray(stArr, out=np.empty(self.n, np.float32))
+        with self.assertRaises(ValueError):
+            st.stallone_array_to_ndarray(stArr, out=np.empty(2 * self.n)[::2])
+
+    def testStrictCopiesRaise(self):
+        with st.strict_copies('raise'):
+            with self.assertRaises(st.ImplicitCopyError):
+                st.ndarray_to_stallone_array(self.a.astype(np.float32),
+                                             copy=False)
+            with self.assertRaises(st.ImplicitCopyError):
+                st.ndarray_to_stallone_array(self.a)
+            # no copy involved
+            st.ndarray_to_stallone_array(self.a, copy=False)
+
+        # audit is disabled again outside of the with block
+        st.ndarray_to_stallone_array(self.a)
+
+    def testStrictCopiesThreadLocal(self):
+        import threading
+        errors = []
+
+        def convert():
+            try:
+                st.ndarray_to_stallone_array(self.a)
+            except st.ImplicitCopyError as e:
+                errors.append(e)
+
+        with st.strict_copies('raise'):
+            # other threads are not affected by the with block
+            t = threading.Thread(target=convert)
+            t.start()
+            t.join()
+        self.assertEqual([], errors)
+
+    def testStrictCopiesThreshold(self):
+        with st.strict_copies('raise', threshold=self.n):
+            st.ndarray_to_stallone_array(self.a)
+
+    def testStrictCopiesLog(self):
+        import logging
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        handler = Handler()
+        logging.getLogger('pystallone').addHandler(handler)
+        try:
+            with st.strict_copies('log'):
+                st.jarray(self.a)
+        finally:
+            logging.getLogger('pystallone').removeHandler(handler)
+        self.assertEqual(1, len(records))
+
+    def testConversionComplex(self):
+        a = self.a + 1j * self.a[::-1]
+        b = st.ndarray_to_stallone_array(a)
+        self.convertToNPandCompare(b, a)
+
+    def testConversionComplex2dOut(self):
+        a = (self.a + 1j * self.a[::-1]).reshape((10, self.n // 10))
+        b = st.ndarray_to_stallone_array(a)
+        out = np.empty_like(a)
+        self.assertIs(out, st.stallone_array_to_ndarray(b, out=out))
+        self.compareNP(a, out)
+
+    def testTake(self):
+        stArr = st.ndarray_to_stallone_array(self.a)
+        ind = np.array([0, 5, 5, 999, -1])
+        self.compareNP(self.a[ind], st.take(stArr, ind))
+
+    def testTakeInt2d(self):
+        a = TestPyStallone.int_array.reshape((10, self.n // 10))
+        stArr = st.ndarray_to_stallone_array(a)
+        ind = np.array([[1, 2], [150, 999]])
+        self.compareNP(a.take(ind), st.take(stArr, ind))
+
+    def testPut(self):
+        stArr = st.ndarray_to_stallone_array(self.a)
+        ind = np.array([1, 3, 7])
+        values = np.array([-1.0, -3.0, -7.0])
+        st.put(stArr, ind, values)
+        self.a[ind] = values
+        self.convertToNPandCompare(stArr, self.a)
+
+    def testPutInt2d(self):
+        a = TestPyStallone.int_array.reshape((10, self.n // 10)).copy()
+        stArr = st.ndarray_to_stallone_array(a)
+        # runs crossing a row, repeated and negative indices
+        ind = np.array([a.shape[1] - 1, a.shape[1], 5, 5, -1])
+        values = np.array([-1, -2, -3, -5, -9], dtype=np.int32)
+        st.put(stArr, ind, values)
+        a.flat[ind] = values
+        self.convertToNPandCompare(stArr, a)
+
+    def testPutEmpty(self):
+        stArr = st.ndarray_to_stallone_array(self.a)
+        st.put(stArr, [], 1.0)
+        st.put(stArr, np.array([], dtype=int), np.array([]))
+        self.convertToNPandCompare(stArr, self.a)
+
 if __name__ == "__main__":
     unittest2.main()
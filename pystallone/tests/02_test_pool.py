@@ -0,0 +1,44 @@
+import unittest2
+
+import sys
+import numpy as np
+import pystallone as st
+if sys.version_info >= (3, 8):
+    from pystallone.pool import Pool
+
+
+def stallone_sum(a):
+    # executed in a worker, which has its own jvm
+    arr = st.ndarray_to_stallone_array(a)
+    return st.API.doubles.sum(arr)
+
+
+@unittest2.skipIf(sys.version_info < (3, 8),
+                  'pystallone.pool requires Python 3.8')
+class TestPool(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestPool, cls).setUpClass()
+        if not st.isJVMStarted():
+            st.startJVM()
+
+    def testForkRefused(self):
+        with self.assertRaises(ValueError):
+            Pool(1, context='fork')
+
+    def testSharedArray(self):
+        with Pool(1) as pool:
+            a = np.arange(10, dtype=np.float64)
+            shared = pool.share(a)
+            self.assertTrue(np.all(a == shared.ndarray))
+            shared.release()
+
+    def testMap(self):
+        data = [np.random.random(100) for _ in range(4)]
+        with Pool(2) as pool:
+            sums = pool.map(stallone_sum, data)
+        self.assertTrue(np.allclose([d.sum() for d in data], sums))
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,46 @@
+import unittest2
+
+import sys
+import numpy as np
+import pystallone as st
+if sys.version_info >= (3, 7):
+    import asyncio
+    from pystallone import aio
+
+
+def run(*coroutines):
+    """ runs the coroutines concurrently in a new event loop """
+    loop = asyncio.new_event_loop()
+    try:
+        tasks = [loop.create_task(c) for c in coroutines]
+        loop.run_until_complete(asyncio.wait(tasks))
+        return [t.result() for t in tasks]
+    finally:
+        loop.close()
+
+
+@unittest2.skipIf(sys.version_info < (3, 7),
+                  'pystallone.aio requires Python 3.7')
+class TestAio(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestAio, cls).setUpClass()
+        if not st.isJVMStarted():
+            st.startJVM()
+
+    def testRoundTrip(self):
+        a = np.random.random(100)
+        b, = run(aio.to_stallone(a))
+        back, = run(aio.to_ndarray(b))
+        self.assertTrue(np.all(a == back))
+
+    def testConcurrentCalls(self):
+        aio.configure(2)
+        arrays = [np.random.random(10) for _ in range(8)]
+        stArrays = run(*[aio.to_stallone(a) for a in arrays])
+        sizes = run(*[aio.call(x.size) for x in stArrays])
+        self.assertEqual([10] * 8, sizes)
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,91 @@
+import unittest2
+
+import numpy as np
+import pystallone as st
+from pystallone.arrays import StalloneArray, SegmentedArray, iter_chunks
+
+
+class TestStalloneArray(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestStalloneArray, cls).setUpClass()
+        if not st.isJVMStarted():
+            st.startJVM()
+
+    def setUp(self):
+        self.a = np.random.random((100, 5))
+        self.proxy = StalloneArray(st.ndarray_to_stallone_array(self.a))
+
+    def testAttributes(self):
+        self.assertEqual(self.a.shape, self.proxy.shape)
+        self.assertEqual(np.float64, self.proxy.dtype)
+        self.assertEqual(100, len(self.proxy))
+
+    def testGetItem(self):
+        for key in [3, -1, slice(10, 20), slice(None, None, 7), [1, 5, 1],
+                    (slice(2, 4), 3), (7, slice(1, 3))]:
+            self.assertTrue(np.all(self.a[key] == self.proxy[key]),
+                            'differs for key %s' % (key,))
+
+    def testAsArray(self):
+        self.assertTrue(np.all(self.a == np.asarray(self.proxy)))
+
+    def testDirectBufferIsView(self):
+        a = np.arange(10, dtype=np.int32)
+        proxy = StalloneArray(a)
+        self.assertTrue(np.may_share_memory(a, proxy[2:5]))
+        a[3] = 42
+        self.assertEqual(42, proxy.stallone.get(3))
+
+    def testCastKeepsBase(self):
+        a = np.arange(10, dtype=np.float32)
+        proxy = StalloneArray(a)
+        self.assertEqual(np.float64, proxy.base.dtype)
+        self.assertTrue(np.all(a == proxy[:]))
+        self.assertEqual(9, proxy.stallone.get(9))
+
+    def testGetItemNumpyInt(self):
+        proxy = StalloneArray(st.ndarray_to_stallone_array(self.a[:, 0].copy()))
+        self.assertEqual(self.a[4, 0], proxy[np.int64(4)])
+
+    def testIterChunks(self):
+        for prefetch in (True, False):
+            blocks = [b.copy() for b in iter_chunks(self.proxy, chunksize=30,
+                                                    prefetch=prefetch)]
+            self.assertEqual([30, 30, 30, 10], [len(b) for b in blocks])
+            self.assertTrue(np.all(self.a == np.concatenate(blocks)))
+
+    def testZerosShared(self):
+        for dtype in (np.float64, np.int32):
+            z = st.zeros((4, 3), dtype)
+            self.assertEqual((4, 3), z.base.shape)
+            self.assertEqual(dtype, z.base.dtype)
+            self.assertTrue(np.all(z.base == 0))
+            z.base[1, 2] = 7
+            self.assertEqual(7, z.stallone.get(1, 2))
+            z.stallone.set(3, 0, 5)
+            self.assertEqual(5, z.base[3, 0])
+
+    def testEmptyUnsupportedType(self):
+        with self.assertRaises(TypeError):
+            st.empty(10, np.float32)
+
+    def testSegmentedArray(self):
+        for copy in (True, False):
+            seg = SegmentedArray(self.a, copy=copy, max_segment_rows=30)
+            self.assertEqual(4, len(seg.segments))
+            self.assertEqual([0, 30, 60, 90, 100], list(seg.offsets))
+            self.assertEqual((1, 15), seg.locate(45))
+            self.assertEqual(self.a[-1, 2], seg.get(-1, 2))
+            self.assertTrue(np.all(self.a == st.stallone_array_to_ndarray(seg)))
+
+    def testSegmentedArrayOut(self):
+        a = np.arange(1000, dtype=np.int32)
+        seg = SegmentedArray(a, max_segment_rows=300)
+        out = np.empty_like(a)
+        st.stallone_array_to_ndarray(seg, out=out)
+        self.assertTrue(np.all(a == out))
+
+if __name__ == "__main__":
+    unittest2.main()
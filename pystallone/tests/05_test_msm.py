@@ -0,0 +1,199 @@
+import unittest2
+
+import numpy as np
+import pystallone as st
+from pystallone import msm
+
+
+def count_loop(dtrajs, lag, nstates):
+    C = np.zeros((nstates, nstates))
+    for d in dtrajs:
+        for i in range(len(d) - lag):
+            C[d[i], d[i + lag]] += 1
+    return C
+
+
+class TestMSM(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestMSM, cls).setUpClass()
+        if not st.isJVMStarted():
+            st.startJVM()
+
+    def setUp(self):
+        self.dtrajs = [np.random.randint(0, 4, size=1000).astype(np.int32),
+                       np.random.randint(0, 4, size=200)]
+
+    def testCountMatrixSliding(self):
+        for lag in (1, 3, 10):
+            C = msm.count_matrix(self.dtrajs, lag)
+            self.assertTrue(np.all(count_loop(self.dtrajs, lag, 4) ==
+                                   C.toarray()))
+
+    def testCountMatrixStrided(self):
+        C = msm.count_matrix(self.dtrajs, 5, sliding=False)
+        strided = [d[::5] for d in self.dtrajs]
+        self.assertTrue(np.all(count_loop(strided, 1, 4) == C.toarray()))
+
+    def testCountMatrixUnassigned(self):
+        C = msm.count_matrix(np.array([0, 1, -1, 1, 0]), nstates=3)
+        self.assertEqual((3, 3), C.shape)
+        self.assertEqual(2, C.sum())
+
+    def testCountMatrixTooFewStates(self):
+        with self.assertRaises(ValueError):
+            msm.count_matrix(np.array([0, 1, 3, 1]), nstates=3)
+
+    def testLargestConnectedSet(self):
+        C = np.array([[1, 1, 0], [1, 1, 0], [0, 1, 1]])
+        self.assertEqual([0, 1], list(msm.largest_connected_set(C)))
+
+    def testTransitionMatrix(self):
+        C = msm.count_matrix(self.dtrajs, 1)
+        for reversible in (True, False):
+            T = msm.transition_matrix(C, reversible=reversible)
+            self.assertEqual((4, 4), T.shape)
+            self.assertTrue(np.allclose(1, T.sum(axis=1)))
+
+    def testTransitionMatrixIntCounts(self):
+        C = msm.count_matrix(self.dtrajs, 1).toarray()
+        T = msm.transition_matrix(C.astype(np.int32), reversible=False)
+        self.assertTrue(np.allclose(C / C.sum(axis=1)[:, None], T))
+
+    def testTransitionMatrixWarmStartOut(self):
+        C = msm.count_matrix(self.dtrajs, 1).toarray()
+        T = msm.transition_matrix(C)
+        out = np.empty_like(C)
+        res = msm.transition_matrix(C, T0=T, out=out)
+        self.assertIs(out, res)
+        self.assertTrue(np.allclose(T, out, atol=1e-6))
+        # T0 and out may share memory
+        msm.transition_matrix(C, T0=out, out=out)
+        self.assertTrue(np.allclose(T, out, atol=1e-6))
+
+    def testImpliedTimescales(self):
+        lags = [1, 2, 5]
+        its = msm.implied_timescales(self.dtrajs, lags, k=2)
+        self.assertEqual((3, 2), its.shape)
+        for i, lag in enumerate(lags):
+            serial = msm.implied_timescales(self.dtrajs, [lag], k=2, n_jobs=1)
+            self.assertTrue(np.allclose(serial[0], its[i]))
+
+    def testStationaryDistributions(self):
+        C = msm.count_matrix(self.dtrajs, 1).toarray()
+        Ts = np.array([msm.transition_matrix(C + i) for i in range(5)])
+        pis = msm.stationary_distributions(Ts)
+        self.assertEqual((5, 4), pis.shape)
+        for T, pi in zip(Ts, pis):
+            self.assertTrue(np.allclose(pi, np.dot(pi, T)))
+            self.assertAlmostEqual(1.0, pi.sum())
+
+    def testEigenvalues(self):
+        C = msm.count_matrix(self.dtrajs, 1).toarray()
+        Ts = np.array([msm.transition_matrix(C + i) for i in range(5)])
+        ev = msm.eigenvalues(Ts, k=2)
+        self.assertEqual((5, 2), ev.shape)
+        for T, e in zip(Ts, ev):
+            expected = np.linalg.eigvals(T)
+            expected = expected[np.argsort(-np.abs(expected))][:2]
+            self.assertTrue(np.allclose(expected, e))
+
+    def testSampleTransitionMatrices(self):
+        C = msm.count_matrix(self.dtrajs, 1).toarray()
+        for reversible in (True, False):
+            Ts = msm.sample_transition_matrices(C, 10, n_chains=3,
+                                                reversible=reversible,
+                                                burn_in=10, thin=10, seed=1)
+            self.assertEqual((10, 4, 4), Ts.shape)
+            self.assertTrue(np.allclose(1, Ts.sum(axis=2)))
+
+    def testSampleTransitionMatricesReproducible(self):
+        C = msm.count_matrix(self.dtrajs, 1).toarray()
+        a = msm.sample_transition_matrices(C, 6, reversible=False, seed=42)
+        b = msm.sample_transition_matrices(C, 6, reversible=False, seed=42)
+        self.assertTrue(np.all(a == b))
+
+    def testSampleReduceRingBuffer(self):
+        C = msm.count_matrix(self.dtrajs, 1).toarray()
+        out = np.empty((4, 4))
+        res = msm.sample_transition_matrices(C, 10, n_chains=2, thin=10,
+                                             reduce=np.diag, out=out)
+        self.assertIs(out, res)
+        self.assertTrue(np.all((out >= 0) & (out <= 1)))
+
+        # 5 samples per chain, each chain keeps its latest 2 in own slots
+        full = msm.sample_transition_matrices(C, 10, n_chains=2,
+                                              reversible=False, reduce=np.diag,
+                                              seed=7)
+        out = msm.sample_transition_matrices(C, 10, n_chains=2,
+                                             reversible=False, reduce=np.diag,
+                                             out=np.empty((4, 4)), seed=7)
+        self.assertTrue(np.all(full[[4, 3, 9, 8]] == out))
+
+    def testBootstrap(self):
+        dtrajs = [np.random.randint(0, 3, size=100) for _ in range(10)]
+        its = msm.bootstrap(dtrajs, 1, 8, k=2, seed=3)
+        self.assertEqual((8, 2), its.shape)
+        pi = msm.bootstrap(dtrajs, 1, 8, observable=lambda T: T[0, 0], seed=3)
+        self.assertEqual((8,), pi.shape)
+
+    def testCommittors(self):
+        T = np.array([[0.8, 0.2, 0.0], [0.1, 0.8, 0.1], [0.0, 0.2, 0.8]])
+        pairs = [([0], [2]), ([2], [0]), ([0, 1], [2])]
+        qplus, qminus = msm.committors(T, pairs, backward=True)
+        self.assertEqual((3, 3), qplus.shape)
+        self.assertTrue(np.allclose([0, 0.5, 1], qplus[0]))
+        self.assertTrue(np.allclose([1, 0.5, 0], qplus[1]))
+        self.assertTrue(np.allclose([0, 0, 1], qplus[2]))
+        # T is reversible, so backward = 1 - forward
+        self.assertTrue(np.allclose(1 - qplus, qminus))
+
+    def testMfpts(self):
+        T = np.array([[0.9, 0.1], [0.3, 0.7]])
+        m = msm.mfpts(T, [[1], [0], [0, 1]], lag=2)
+        self.assertTrue(np.allclose([[20, 0], [0, 2 / 0.3], [0, 0]], m))
+
+    def testPropagate(self):
+        from scipy.sparse import csr_matrix
+        T = np.array([[0.8, 0.2, 0.0], [0.1, 0.8, 0.1], [0.0, 0.2, 0.8]])
+        p0 = np.eye(3)[:2]
+        steps = [5, 0, 2]
+        for M in (T, csr_matrix(T)):
+            p = msm.propagate(M, p0, steps)
+            self.assertEqual((2, 3, 3), p.shape)
+            for j, k in enumerate(steps):
+                expected = np.dot(p0, np.linalg.matrix_power(T, k))
+                self.assertTrue(np.allclose(expected, p[:, j, :]))
+        self.assertEqual((3, 3), msm.propagate(T, p0[0], steps).shape)
+
+    def testCKTest(self):
+        sets = [[0, 1], [2, 3]]
+        predicted, estimated = msm.cktest(self.dtrajs, sets, 1, [1, 2, 4])
+        self.assertEqual((3, 2, 2), predicted.shape)
+        self.assertEqual((3, 2, 2), estimated.shape)
+        # for k = 1 both models are the same
+        self.assertTrue(np.allclose(predicted[0], estimated[0]))
+        self.assertTrue(np.allclose(1, predicted.sum(axis=2)))
+
+    def testPCCA(self):
+        # three metastable blocks of three states
+        C = np.random.rand(9, 9) * 0.01
+        for b in range(3):
+            C[3 * b:3 * b + 3, 3 * b:3 * b + 3] += 1
+        C += C.T
+        T = C / C.sum(axis=1)[:, None]
+        pcca = msm.PCCA(T)
+        chi2, chi3 = pcca.memberships([2, 3])
+        self.assertEqual((9, 2), chi2.shape)
+        self.assertTrue(np.allclose(1, chi3.sum(axis=1)))
+        sets = pcca.metastable_assignment(3)
+        self.assertEqual(3, len(np.unique(sets)))
+        self.assertTrue(np.all(sets.reshape(3, 3) == sets[::3, None]))
+        # worker processes give the same memberships
+        for a, b in zip(msm.PCCA(T).memberships([2, 3], n_jobs=2),
+                        [chi2, chi3]):
+            self.assertTrue(np.allclose(a, b))
+
+if __name__ == "__main__":
+    unittest2.main()
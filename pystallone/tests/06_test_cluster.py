@@ -0,0 +1,87 @@
+import unittest2
+
+import numpy as np
+import pystallone as st
+from pystallone.cluster import KMeans, RegularSpaceClustering, assign_batch
+
+
+class TestCluster(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestCluster, cls).setUpClass()
+        if not st.isJVMStarted():
+            st.startJVM()
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        self.means = np.array([[0., 0.], [3., 3.], [0., 5.]])
+        self.X = np.vstack([random.randn(300, 2) * 0.1 + m
+                            for m in self.means])
+        random.shuffle(self.X)
+
+    def compareCenters(self, centers, atol=0.1):
+        self.assertEqual(3, len(centers))
+        order = np.argsort(centers[:, 0] + 2 * centers[:, 1])
+        self.assertTrue(np.allclose(self.means, centers[order], atol=atol))
+
+    def testKMeans(self):
+        km = KMeans(3, max_iter=20, chunksize=100, seed=1)
+        km.fit([self.X[:500], self.X[500:]])
+        self.compareCenters(km.centers)
+
+    def testMiniBatchKMeans(self):
+        km = KMeans(3, max_iter=5, batch_size=50, seed=1).fit(self.X)
+        self.compareCenters(km.centers)
+        self.assertEqual([300, 300, 300],
+                         sorted(np.bincount(km.assign(self.X))))
+
+    def testKMeansChunkIterator(self):
+        # a generator can only be iterated once
+        chunks = (self.X[i:i + 100] for i in range(0, len(self.X), 100))
+        km = KMeans(3, seed=1).fit(chunks)
+        self.compareCenters(km.centers)
+        with self.assertRaises(ValueError):
+            KMeans(3).fit(iter([]))
+
+    def testRegularSpace(self):
+        reg = RegularSpaceClustering(1.5, chunksize=64).fit(self.X)
+        # centers are frames, not means
+        self.compareCenters(reg.centers, atol=0.5)
+
+    def testStalloneCenters(self):
+        reg = RegularSpaceClustering(1.5).fit(self.X)
+        centers = st.stallone_array_to_ndarray(reg.stallone_centers)
+        self.assertTrue(np.all(reg.centers == centers))
+
+    def testAssignBatch(self):
+        km = KMeans(3, seed=1).fit(self.X)
+        trajs = [self.X[:400], self.X[400:], iter([self.X[:10], self.X[10:15]])]
+        out = [np.empty(400, dtype=np.int32), None, None]
+        dtrajs, fps = assign_batch(km.stallone_centers, trajs, out=out,
+                                   chunksize=64, return_throughput=True)
+        self.assertIs(out[0], dtrajs[0])
+        self.assertTrue(np.all(km.assign(self.X[:400]) == dtrajs[0]))
+        self.assertTrue(np.all(km.assign(self.X[400:]) == dtrajs[1]))
+        self.assertTrue(np.all(km.assign(self.X[:15]) == dtrajs[2]))
+        self.assertEqual(np.int32, dtrajs[2].dtype)
+        self.assertTrue(fps > 0)
+
+    def testAssignBatchStreams(self):
+        km = KMeans(3, seed=1).fit(self.X)
+        out = np.empty(len(self.X), dtype=np.int32)
+        out[:] = -1
+        pending = []
+
+        def chunks():
+            for start in range(0, len(self.X), 10):
+                # chunks handed out before, which are not assigned yet
+                pending.append(np.count_nonzero(out[:start] == -1) // 10)
+                yield self.X[start:start + 10]
+
+        dtrajs = assign_batch(km.centers, [chunks()], out=[out], n_jobs=1)
+        self.assertTrue(np.all(km.assign(self.X) == dtrajs[0]))
+        self.assertTrue(max(pending) <= 2)
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,89 @@
+import unittest2
+
+import os
+import tempfile
+import numpy as np
+import pystallone as st
+from pystallone.coor import CovarianceAccumulator, pca, tica, project_batch
+
+
+class TestCovarianceAccumulator(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestCovarianceAccumulator, cls).setUpClass()
+        if not st.isJVMStarted():
+            st.startJVM()
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        # large offset to check numerical stability
+        self.trajs = [random.randn(n, 3) + 1e6 for n in (500, 37, 3)]
+        self.lag = 5
+
+    def testInstantaneous(self):
+        acc = CovarianceAccumulator()
+        for t in self.trajs:
+            acc.add_trajectory(t, chunksize=7)
+        X = np.vstack(self.trajs)
+        self.assertEqual(len(X), acc.n)
+        self.assertTrue(np.allclose(X.mean(axis=0), acc.mean))
+        self.assertTrue(np.allclose(np.cov(X.T), acc.cov))
+        self.assertIsNone(acc.cov_tau)
+
+    def testLaggedMerge(self):
+        acc = CovarianceAccumulator(self.lag)
+        acc.add_trajectory(self.trajs[0], chunksize=3)
+        other = CovarianceAccumulator(self.lag)
+        for t in self.trajs[1:]:
+            other.add_trajectory(t, chunksize=10)
+        acc.merge(other)
+
+        X = np.vstack([t[:-self.lag] for t in self.trajs[:2]])
+        Y = np.vstack([t[self.lag:] for t in self.trajs[:2]])
+        expected = np.dot((X - X.mean(axis=0)).T, Y - Y.mean(axis=0)) \
+            / (len(X) - 1)
+        self.assertEqual(len(X), acc.n_tau)
+        self.assertTrue(np.allclose(expected, acc.cov_tau))
+
+    def testMergeDifferentLag(self):
+        with self.assertRaises(ValueError):
+            CovarianceAccumulator(1).merge(CovarianceAccumulator(2))
+
+    def testStalloneCov(self):
+        acc = CovarianceAccumulator(self.lag).add_trajectory(self.trajs[0])
+        cov, cov_tau = acc.stallone_cov()
+        self.assertTrue(np.allclose(acc.cov, st.stallone_array_to_ndarray(cov)))
+        self.assertTrue(np.allclose(acc.cov_tau,
+                                    st.stallone_array_to_ndarray(cov_tau)))
+
+    def testTicaFindsSlowProcess(self):
+        random = np.random.RandomState(1)
+        slow = np.zeros(5000)
+        for t in range(1, len(slow)):
+            slow[t] = 0.99 * slow[t - 1] + 0.1 * random.randn()
+        X = np.column_stack((slow + 0.2 * random.randn(len(slow)),
+                             random.randn(len(slow))))
+        acc = CovarianceAccumulator(5).add_trajectory(X, chunksize=100)
+        y = tica(acc).transform(X, dim=1)[:, 0]
+        self.assertTrue(abs(np.corrcoef(y, slow)[0, 1]) > 0.9)
+
+    def testProjectBatch(self):
+        acc = CovarianceAccumulator()
+        for t in self.trajs:
+            acc.add_trajectory(t)
+        transform = pca(acc)
+        fd, filename = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        try:
+            out = [filename, np.empty((37, 2)), None]
+            Y = project_batch(transform, self.trajs, 2, out=out, chunksize=16)
+            self.assertIs(out[1], Y[1])
+            for t, y in zip(self.trajs, Y):
+                self.assertTrue(np.allclose(transform.transform(t, 2), y))
+            self.assertTrue(np.allclose(Y[0], np.load(filename)))
+        finally:
+            os.remove(filename)
+
+if __name__ == "__main__":
+    unittest2.main()
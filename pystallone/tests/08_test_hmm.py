@@ -0,0 +1,86 @@
+import unittest2
+
+import numpy as np
+import pystallone as st
+from pystallone.hmm import HMM, Observations
+
+
+def simulate(A, n, random):
+    s = np.zeros(n, dtype=int)
+    for t in range(1, n):
+        s[t] = random.choice(len(A), p=A[s[t - 1]])
+    return s
+
+
+class TestHMM(unittest2.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestHMM, cls).setUpClass()
+        if not st.isJVMStarted():
+            st.startJVM()
+
+    def setUp(self):
+        self.random = np.random.RandomState(1)
+        self.A = np.array([[0.95, 0.05], [0.1, 0.9]])
+        self.paths = [simulate(self.A, n, self.random) for n in (2000, 500, 1)]
+
+    def testObservations(self):
+        obs = Observations([np.arange(3), np.arange(5)])
+        self.assertTrue(obs.discrete)
+        self.assertEqual(np.int32, obs.data.dtype)
+        self.assertEqual(2, len(obs))
+        self.assertTrue(np.all(obs[1] == np.arange(5)))
+
+    def testDiscrete(self):
+        B = np.array([[0.8, 0.2, 0.0], [0.1, 0.2, 0.7]])
+        obs = [np.array([self.random.choice(3, p=B[s]) for s in path])
+               for path in self.paths]
+        for engine in ('stallone', 'numpy'):
+            hmm = HMM(2, seed=0, engine=engine).fit(obs)
+            # hidden states are identified up to permutation
+            order = np.argsort(hmm.output_probabilities[:, 0])[::-1]
+            self.assertTrue(np.allclose(self.A, hmm.transition_matrix[order][
+                                        :, order], atol=0.05))
+            self.assertTrue(np.allclose(B, hmm.output_probabilities[order],
+                                        atol=0.05))
+            paths = hmm.viterbi()
+            self.assertEqual([len(o) for o in obs], [len(p) for p in paths])
+            correct = np.mean(order[np.concatenate(paths)] ==
+                              np.concatenate(self.paths))
+            self.assertGreater(correct, 0.9)
+
+    def testGaussian(self):
+        obs = [s + 0.3 * self.random.randn(len(s)) for s in self.paths]
+        for engine in ('stallone', 'numpy'):
+            hmm = HMM(2, seed=0, engine=engine).fit(obs)
+            self.assertTrue(np.allclose([0, 1], np.sort(hmm.means),
+                                        atol=0.05))
+            self.assertTrue(np.allclose(0.09, hmm.variances, atol=0.02))
+            order = np.argsort(hmm.means)
+            self.assertTrue(np.allclose(self.A, hmm.transition_matrix[order][
+                                        :, order], atol=0.05))
+
+    def testEmptyTrajectory(self):
+        obs = [np.array([0, 1, 1]), np.array([], dtype=int), np.array([2])]
+        for engine in ('stallone', 'numpy'):
+            hmm = HMM(2, seed=0, engine=engine).fit(obs)
+            self.assertEqual([3, 0, 1], [len(p) for p in hmm.viterbi()])
+
+    def testUnknownEngine(self):
+        with self.assertRaises(ValueError):
+            HMM(2, engine='fortran')
+
+    def testProcesses(self):
+        obs = [s + 0.3 * self.random.randn(len(s)) for s in self.paths]
+        serial = HMM(2, seed=0, max_iter=5, tol=0, engine='numpy').fit(obs)
+        parallel = HMM(2, seed=0, max_iter=5, tol=0, n_jobs=2,
+                       engine='numpy').fit(obs)
+        self.assertTrue(np.allclose(serial.transition_matrix,
+                                    parallel.transition_matrix))
+        self.assertTrue(np.allclose(serial.means, parallel.means))
+        for a, b in zip(serial.viterbi(), parallel.viterbi()):
+            self.assertTrue(np.all(a == b))
+
+if __name__ == "__main__":
+    unittest2.main()
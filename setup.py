@@ -14,7 +14,6 @@ Natural Language :: English
 Operating System :: MacOS :: MacOS X
 Operating System :: POSIX :: Linux
 Programming Language :: Java
-Programming Language :: Python :: 2.6
 Programming Language :: Python :: 2.7
 Programming Language :: Python :: 3
 Topic :: Scientific/Engineering :: Bio-Informatics
@@ -147,7 +146,8 @@ metadata = dict(
     packages=['pystallone'],
     package_data={'pystallone': [jar_name]},
     install_requires=[jpype_species,
-                      'numpy >= 1.6.0'],
+                      'numpy >= 1.13',
+                      'scipy'],
     tests_require=['unittest2', 'nose'],
     test_suite='nose.collector',
     zip_safe=False,